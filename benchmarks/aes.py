@@ -0,0 +1,60 @@
+"""Compare the AES-128-CBC backends in MB/s, on one thread and on several.
+
+    python -m benchmarks.aes --size 64 --threads 4
+"""
+
+import argparse
+import concurrent.futures
+import os
+import time
+
+from smiling import _crypto
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--segment', type=int, default=512,
+                        help='KiB per segment')
+    parser.add_argument('--size', type=float, default=64,
+                        help='MiB to decrypt, divided by 64 for python')
+    parser.add_argument('--threads', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+    key = os.urandom(16)
+    iv = os.urandom(16)
+    # Decrypted in place over and over, which only garbles it
+    segment = bytearray(os.urandom(args.segment * 1024))
+
+    print(f'{"backend":10} {"1 thread":>13} {f"{args.threads} threads":>13}')
+    for name, factory in _crypto.BACKENDS.items():
+        try:
+            backend = factory()
+        except (ImportError, OSError) as e:
+            print(f'{name:10} unavailable: {e}')
+            continue
+        try:
+            size = args.size * (1 / 64 if name == 'python' else 1)
+            count = max(1, round(size * 1024 / args.segment))
+            decrypt = backend.cipher(key, iv)
+            single = _rate(decrypt, segment, count, 1)
+            multi = _rate(decrypt, segment, count, args.threads)
+            print(f'{name:10} {single:8.1f} MB/s {multi:8.1f} MB/s')
+        finally:
+            backend.close()
+
+
+def _rate(
+    decrypt: _crypto.Cipher,
+    segment: bytearray,
+    count: int,
+    threads: int,
+):
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        list(executor.map(decrypt, [segment] * threads))  # Warm up
+        start = time.perf_counter()
+        list(executor.map(decrypt, [segment] * count))
+        seconds = time.perf_counter() - start
+    return len(segment) * count / seconds / 1e6
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""End-to-end download benchmark against the local stand-in server.
+
+Each combination of track length and `parallel` runs `download` in a fresh
+process with its own data directory, reporting wall time, CPU and peak RSS:
+
+    python -m benchmarks.download --minutes 2 10 --parallel 1 5 10
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from . import fake_server
+
+_ROOT = os.path.abspath(os.path.join(__file__, '../..'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--adaptive', action='store_true',
+                        help='let the pool adapt instead of pinning it')
+    parser.add_argument('--bandwidth', type=float,
+                        help='bytes/s per request')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--errors', type=float, default=0.0,
+                        help='probability of a 503 per segment request')
+    parser.add_argument('--format', choices=('best', 'worst'), default='best')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds before each response')
+    parser.add_argument('--minutes', type=float, nargs='+', default=[2, 10])
+    parser.add_argument('--parallel', type=int, nargs='+', default=[1, 5, 10])
+    args = parser.parse_args()
+    if args.child:
+        _child(args.child, args.format)
+        return
+
+    print(
+        f'{"minutes":>8} {"parallel":>8} {"seconds":>8} {"cpu s":>8} '
+        f'{"ffmpeg s":>8} {"RSS MiB":>8}',
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        certfile, keyfile = fake_server.make_certificate(tmp)
+        for minutes in args.minutes:
+            track_dir = os.path.join(tmp, f'track-{minutes}')
+            fake_server.make_track(track_dir, minutes * 60)
+            server = subprocess.Popen(
+                [
+                    sys.executable, '-m', 'benchmarks.fake_server',
+                    track_dir,
+                    '--certfile', certfile,
+                    '--keyfile', keyfile,
+                    '--errors', str(args.errors),
+                    '--latency', str(args.latency),
+                    *(['--bandwidth', str(args.bandwidth)]
+                      if args.bandwidth else []),
+                ],
+                cwd=_ROOT,
+                stdout=subprocess.PIPE,
+                text=True,
+            )
+            try:
+                assert server.stdout
+                port = int(server.stdout.readline())
+                for parallel in args.parallel:
+                    row = _run(
+                        os.path.join(tmp, f'run-{minutes}-{parallel}'),
+                        port,
+                        parallel,
+                        certfile,
+                        args.adaptive,
+                        args.format,
+                    )
+                    print(
+                        f'{minutes:8g} {parallel:8d} {row["seconds"]:8.2f} '
+                        f'{row["cpu"]:8.2f} {row["ffmpeg"]:8.2f} '
+                        f'{row["rss"] or float("nan"):8.1f}',
+                    )
+            finally:
+                server.terminate()
+                server.wait()
+
+
+def _child(id_: str, format_: str):
+    from smiling import _downloader
+    from smiling import _main
+
+    async def download():
+        async with _main._states(logging.INFO) as s:  # pyright: ignore[reportPrivateUsage]
+            _main.states.set(s)
+            start = time.perf_counter()
+            await _downloader.download(id_, format_)  # pyright: ignore[reportArgumentType]
+            return time.perf_counter() - start
+
+    seconds = asyncio.run(download())
+    cpu = sum(os.times()[:2])
+    ffmpeg = sum(os.times()[2:4])
+    if resource:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        rss /= 1024 * (1024 if sys.platform == 'darwin' else 1)
+    else:
+        rss = None
+    print(json.dumps({
+        'seconds': seconds,
+        'cpu': cpu,
+        'ffmpeg': ffmpeg,
+        'rss': rss,
+    }))
+
+
+def _run(
+    run_dir: str,
+    port: int,
+    parallel: int,
+    certfile: str,
+    adaptive: bool,
+    format_: str,
+):
+    os.makedirs(run_dir)
+    hosts = '\n'.join(
+        f'{json.dumps(host)} = "127.0.0.1:{port}"'
+        for host in fake_server.HOSTS
+    )
+    bounds = '' if adaptive else (
+        f'parallel_max = {parallel}\nparallel_min = {parallel}\n'
+    )
+    with open(os.path.join(run_dir, 'pyproject.toml'), 'w') as f:
+        f.write(
+            '[tool.smiling]\n'
+            f'cafile = {json.dumps(certfile)}\n'
+            f'data_dir = {json.dumps(run_dir)}\n'
+            f'parallel = {parallel}\n'
+            f'{bounds}'
+            '\n[tool.smiling.hosts]\n'
+            f'{hosts}\n',
+        )
+    result = subprocess.run(
+        [
+            sys.executable, '-m', 'benchmarks.download',
+            '--child', 'sm9',
+            '--format', format_,
+        ],
+        capture_output=True,
+        check=True,
+        cwd=run_dir,
+        env={**os.environ, 'PYTHONPATH': _ROOT},
+        text=True,
+    )
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+if __name__ == '__main__':
+    main()
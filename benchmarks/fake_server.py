@@ -0,0 +1,336 @@
+"""Local stand-in for the Niconico watch page, access rights and Domand CDN.
+
+Serves one generated track for any video ID over HTTPS, with optional
+latency, bandwidth and error injection:
+
+    python -m benchmarks.fake_server TRACK_DIR --certfile C --keyfile K
+"""
+
+import argparse
+import asyncio
+import datetime
+import html
+import json
+import os
+import random
+import re
+import ssl
+import subprocess
+
+HOSTS = (
+    'www.nicovideo.jp',
+    'nvapi.nicovideo.jp',
+    'delivery.domand.nicovideo.jp',
+    'asset.domand.nicovideo.jp',
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('track_dir')
+    parser.add_argument('--bandwidth', type=float, help='bytes/s per request')
+    parser.add_argument('--certfile', required=True)
+    parser.add_argument('--errors', type=float, default=0.0,
+                        help='probability of a 503 per segment request')
+    parser.add_argument('--expire', type=float, default=3600.0,
+                        help='seconds until access rights expire')
+    parser.add_argument('--keyfile', required=True)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds before each response')
+    parser.add_argument('--port', type=int, default=0)
+    args = parser.parse_args()
+    server = FakeServer(
+        args.track_dir,
+        bandwidth=args.bandwidth,
+        errors=args.errors,
+        expire=args.expire,
+        latency=args.latency,
+    )
+    asyncio.run(server.serve(args.port, args.certfile, args.keyfile))
+
+
+def make_certificate(directory: str):
+    """Create a self-signed certificate for all Niconico hosts."""
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    san = ','.join(f'DNS:{host}' for host in HOSTS)
+    subprocess.run(
+        [
+            'openssl', 'req',
+            '-x509',
+            '-newkey', 'rsa:2048',
+            '-nodes',
+            '-days', '1',
+            '-subj', '/CN=smiling-bench',
+            '-addext', f'subjectAltName={san}',
+            '-keyout', keyfile,
+            '-out', certfile,
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return certfile, keyfile
+
+
+def make_track(directory: str, seconds: float):
+    """Encode a sine wave as AES-128 encrypted fMP4 segments."""
+    plain = os.path.join(directory, 'plain')
+    os.makedirs(plain, exist_ok=True)
+    subprocess.run(
+        [
+            'ffmpeg',
+            '-hide_banner',
+            '-loglevel', 'error',
+            '-y',
+            '-f', 'lavfi',
+            '-i', f'sine=frequency=440:duration={seconds}',
+            '-c:a', 'aac',
+            '-b:a', '192k',
+            '-f', 'hls',
+            '-hls_time', '6',
+            '-hls_playlist_type', 'vod',
+            '-hls_segment_type', 'fmp4',
+            '-hls_fmp4_init_filename', 'init.mp4',
+            '-hls_segment_filename', os.path.join(plain, '%d.m4s'),
+            os.path.join(plain, 'index.m3u8'),
+        ],
+        check=True,
+    )
+    key = os.urandom(16)
+    iv = os.urandom(16)
+    durations: list[float] = []
+    with open(os.path.join(plain, 'index.m3u8'), encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('#EXTINF:'):
+                durations.append(float(line[8:].partition(',')[0]))
+    for n in range(len(durations)):
+        subprocess.run(
+            [
+                'openssl', 'enc',
+                '-aes-128-cbc',
+                '-K', key.hex(),
+                '-iv', iv.hex(),
+                '-in', os.path.join(plain, f'{n}.m4s'),
+                '-out', os.path.join(directory, f'{n}.m4s'),
+            ],
+            check=True,
+        )
+    os.replace(
+        os.path.join(plain, 'init.mp4'),
+        os.path.join(directory, 'init.mp4'),
+    )
+    with open(os.path.join(directory, 'key'), 'wb') as f:
+        f.write(key)
+    with open(os.path.join(directory, 'track.json'), 'w') as f:
+        json.dump({'durations': durations, 'iv': iv.hex()}, f)
+
+
+class FakeServer:
+    def __init__(
+        self,
+        track_dir: str,
+        *,
+        bandwidth: float | None = None,
+        errors: float = 0.0,
+        expire: float = 3600.0,
+        latency: float = 0.0,
+    ):
+        self._bandwidth = bandwidth
+        self._errors = errors
+        self._expire = expire
+        self._latency = latency
+        self._track_dir = track_dir
+        with open(os.path.join(track_dir, 'track.json')) as f:
+            track = json.load(f)
+        self._durations: list[float] = track['durations']
+        self._iv: str = track['iv']
+
+    async def serve(self, port: int, certfile: str, keyfile: str):
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(certfile, keyfile)
+        server = await asyncio.start_server(
+            self._handle,
+            '127.0.0.1',
+            port,
+            ssl=ssl_context,
+        )
+        async with server:
+            # Tell the parent process where to connect
+            print(server.sockets[0].getsockname()[1], flush=True)
+            await server.serve_forever()
+
+    async def _handle(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ):
+        try:
+            while line := await reader.readline():
+                method, path, _version = line.decode('ascii').split()
+                headers: dict[str, str] = {}
+                while (line := await reader.readline()) not in (b'\r\n', b''):
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                await reader.readexactly(
+                    int(headers.get('content-length', 0)),
+                )
+                host = headers.get('host', '').partition(':')[0]
+                status, content_type, body = self._route(method, host, path)
+                await asyncio.sleep(self._latency)
+                writer.write(
+                    (
+                        f'HTTP/1.1 {status}\r\n'
+                        f'Content-Type: {content_type}\r\n'
+                        f'Content-Length: {len(body)}\r\n'
+                        '\r\n'
+                    ).encode('ascii'),
+                )
+                await self._send(writer, body)
+        except (ConnectionError, asyncio.IncompleteReadError, ssl.SSLError):
+            pass
+        finally:
+            writer.close()
+
+    def _route(self, method: str, host: str, path: str):
+        match host, method, path.split('?')[0].strip('/').split('/'):
+            case 'www.nicovideo.jp', 'GET', ['watch', id_]:
+                return _OK, 'text/html; charset=utf-8', _watch_page(id_)
+            case (
+                'nvapi.nicovideo.jp',
+                'POST',
+                ['v1', 'watch', id_, 'access-rights', 'hls'],
+            ):
+                return '201 Created', 'application/json', self._access(id_)
+            case 'delivery.domand.nicovideo.jp', 'GET', [id_, 'master.m3u8']:
+                return _OK, _M3U8, _master(id_)
+            case 'delivery.domand.nicovideo.jp', 'GET', [id_, 'audio.m3u8']:
+                return _OK, _M3U8, self._media(id_)
+            case 'delivery.domand.nicovideo.jp', 'GET', [_, 'key']:
+                return _OK, 'application/octet-stream', self._read('key')
+            case 'asset.domand.nicovideo.jp', 'GET', [_, 'init.mp4']:
+                return _OK, 'video/mp4', self._read('init.mp4')
+            case 'asset.domand.nicovideo.jp', 'GET', [_, name]:
+                if random.random() < self._errors:
+                    return '503 Service Unavailable', 'text/plain', b''
+                return _OK, 'video/iso.segment', self._read(name)
+            case _:
+                return '404 Not Found', 'text/plain', b''
+
+    def _access(self, id_: str):
+        now = datetime.datetime.now(datetime.UTC)
+        expire = now + datetime.timedelta(seconds=self._expire)
+        return json.dumps({
+            'data': {
+                'contentUrl': f'https://{_DELIVERY}/{id_}/master.m3u8',
+                'createTime': now.isoformat(),
+                'expireTime': expire.isoformat(),
+            },
+            'meta': {'status': 201},
+        }).encode()
+
+    def _media(self, id_: str):
+        lines = [
+            '#EXTM3U',
+            '#EXT-X-VERSION:6',
+            f'#EXT-X-TARGETDURATION:{round(max(self._durations))}',
+            '#EXT-X-PLAYLIST-TYPE:VOD',
+            f'#EXT-X-MAP:URI="https://{_ASSET}/{id_}/init.mp4"',
+            f'#EXT-X-KEY:METHOD=AES-128,URI="https://{_DELIVERY}/{id_}/key",'
+            f'IV=0x{self._iv}',
+        ]
+        for n, duration in enumerate(self._durations):
+            lines.append(f'#EXTINF:{duration:.6f},')
+            lines.append(f'https://{_ASSET}/{id_}/{n}.m4s')
+        lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines).encode()
+
+    def _read(self, name: str):
+        if not re.fullmatch(r'\w+(\.\w+)?', name):
+            return b''
+        try:
+            with open(os.path.join(self._track_dir, name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return b''
+
+    async def _send(self, writer: asyncio.StreamWriter, body: bytes):
+        if not self._bandwidth:
+            writer.write(body)
+            await writer.drain()
+            return
+        chunk = 16384
+        for i in range(0, len(body), chunk):
+            writer.write(body[i:i+chunk])
+            await writer.drain()
+            await asyncio.sleep(len(body[i:i+chunk]) / self._bandwidth)
+
+
+def _master(id_: str):
+    return '\n'.join([
+        '#EXTM3U',
+        '#EXT-X-VERSION:6',
+        '#EXT-X-INDEPENDENT-SEGMENTS',
+        '#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio",NAME="Main Audio",'
+        f'DEFAULT=YES,URI="https://{_DELIVERY}/{id_}/audio.m3u8"',
+        '#EXT-X-STREAM-INF:BANDWIDTH=200000,AUDIO="audio"',
+        f'https://{_DELIVERY}/{id_}/audio.m3u8',
+    ]).encode()
+
+
+def _watch_page(id_: str):
+    content = {
+        'data': {
+            'response': {
+                'client': {'watchTrackId': 'bench'},
+                'media': {
+                    'domand': {
+                        'accessRightKey': 'bench',
+                        'audios': [
+                            {
+                                'id': 'audio-aac-64kbps',
+                                'isAvailable': True,
+                                'qualityLevel': 0,
+                            },
+                            {
+                                'id': 'audio-aac-192kbps',
+                                'isAvailable': True,
+                                'qualityLevel': 1,
+                            },
+                        ],
+                        'videos': [
+                            {
+                                'id': 'video-h264-360p',
+                                'isAvailable': True,
+                                'qualityLevel': 0,
+                            },
+                        ],
+                    },
+                },
+                'payment': {
+                    'video': {
+                        'isAdmission': False,
+                        'isPremium': False,
+                        'isPpv': False,
+                    },
+                },
+                'video': {'id': id_, 'isDeleted': False},
+            },
+        },
+        'meta': {'code': 'HTTP_200', 'status': 200},
+    }
+    meta = html.escape(json.dumps(content))
+    return (
+        '<!DOCTYPE html><html><head>'
+        f'<meta name="server-response" content="{meta}">'
+        '</head><body></body></html>'
+    ).encode()
+
+
+_ASSET = 'asset.domand.nicovideo.jp'
+_DELIVERY = 'delivery.domand.nicovideo.jp'
+_M3U8 = 'application/vnd.apple.mpegurl'
+_OK = '200 OK'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""Compare the server-response extractors on saved watch pages.
+
+Pages default to those in log/, which only holds pages that failed to
+download. Point it at pages that parse, e.g. saved from a browser:
+
+    python -m benchmarks.parse_html ~/Downloads/sm9.html
+"""
+
+import argparse
+from collections.abc import Callable
+import glob
+import os
+import timeit
+
+from smiling import _parser
+
+
+def main():
+    log_dir = os.path.abspath(os.path.join(__file__, '../../log'))
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('pages', nargs='*', help=f'default: {log_dir}/*.htm*')
+    args = parser.parse_args()
+    pages = args.pages or sorted(glob.iglob(os.path.join(log_dir, '*.htm*')))
+    if not pages:
+        raise SystemExit(f'No saved watch pages in {log_dir}')
+    print(f'{"page":40} {"KiB":>8} {"scan ms":>10} {"bs4 ms":>10}')
+    for page in pages:
+        with open(page, 'rb') as f:
+            markup = f.read()
+        name = os.path.basename(page)
+        if _parser._server_response(markup) is None:  # pyright: ignore[reportPrivateUsage]
+            print(f'{name:40} no server-response')
+            continue
+        scan = _best(lambda: _parser._server_response(markup))  # pyright: ignore[reportPrivateUsage]
+        bs4 = _best(lambda: _parser._server_response_bs4(markup))  # pyright: ignore[reportPrivateUsage]
+        print(f'{name:40} {len(markup)/1024:8.1f} {scan:10.3f} {bs4:10.3f}')
+
+
+def _best(stmt: Callable[[], object], /):
+    timer = timeit.Timer(stmt)
+    number, _ = timer.autorange()
+    return min(timer.repeat(5, number)) / number * 1000
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Check the import time of each entry point against a budget.
+
+Every entry point is imported in a fresh interpreter with `-X importtime`.
+The best cumulative time of several runs must stay within its budget, and
+modules only needed later must not be imported at all:
+
+    python -m benchmarks.startup --repeat 5
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+_ENTRY_POINTS = {  # Module: (default budget in ms, modules kept lazy)
+    'smiling._cli': (300, ('bs4', 'cffi', 'httpx2', 'm3u8', 'rich')),
+    'smiling._main': (600, ('bs4', 'cffi', 'm3u8', 'rich')),
+}
+_ROOT = os.path.abspath(os.path.join(__file__, '../..'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--budget', type=float, nargs='*', default=[],
+                        metavar='MS',
+                        help='budgets in entry point order')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=5,
+                        help='slowest imports to list')
+    args = parser.parse_args()
+    budgets = [budget for budget, _ in _ENTRY_POINTS.values()]
+    budgets[:len(args.budget)] = args.budget
+
+    failures: list[str] = []
+    for (module, (_, lazy)), budget in zip(_ENTRY_POINTS.items(), budgets):
+        runs = [_importtime(module, lazy) for _ in range(args.repeat)]
+        times, imported = min(runs, key=lambda run: run[0][module])
+        total = times[module] / 1000
+        print(f'{module:20} {total:8.1f} ms (budget {budget:g} ms)')
+        for name, us in sorted(
+            times.items(),
+            key=lambda item: item[1],
+            reverse=True,
+        )[1:args.top + 1]:
+            print(f'  {name:40} {us / 1000:8.1f} ms')
+        if total > budget:
+            failures.append(f'{module} took {total:.1f} ms')
+        if imported:
+            failures.append(f'{module} imported {", ".join(imported)}')
+    if failures:
+        sys.exit('\n'.join(failures))
+
+
+def _importtime(module: str, lazy: tuple[str, ...]):
+    """Return cumulative microseconds by module and the lazy ones loaded."""
+    code = (
+        f'import {module}\n'
+        'import sys\n'
+        f'print(*[m for m in {lazy!r} if m in sys.modules])'
+    )
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        capture_output=True,
+        check=True,
+        cwd=_ROOT,
+        text=True,
+    )
+    times: dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _self, cumulative, name = line[12:].split('|')
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times, result.stdout.split()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,15 @@
 import sys
 
-from . import _cli
-from . import _main
-
 
 def main():
+    # Import only what the chosen mode needs, for a faster start
     if len(sys.argv) <= 1:
+        from . import _main
+
         _main.main()
     else:
+        from . import _cli
+
         _cli.main()
 
 
@@ -0,0 +1,8 @@
+# auto-generated file
+import _cffi_backend
+
+ffi = _cffi_backend.FFI('smiling._avutil',
+    _version = 0x2601,
+    _types = b'\x00\x00\x03\x0D\x00\x00\x0E\x03\x00\x00\x0E\x03\x00\x00\x07\x01\x00\x00\x07\x01\x00\x00\x00\x0F\x00\x00\x0F\x0D\x00\x00\x01\x11\x00\x00\x01\x11\x00\x00\x02\x11\x00\x00\x07\x01\x00\x00\x01\x11\x00\x00\x07\x01\x00\x00\x00\x0F\x00\x00\x12\x01\x00\x00\x00\x01',
+    _globals = (b'\x00\x00\x06\x23av_aes_crypt',0,b'\x00\x00\x00\x23av_aes_init',0),
+)
@@ -0,0 +1,38 @@
+"""Declarations of the avutil AES functions.
+
+Run `python -m smiling._avutil_build` to regenerate the out-of-line
+module `_avutil`, which loads them without parsing the C declarations.
+"""
+
+__all__ = ('ffibuilder',)
+
+import os
+
+import cffi
+
+assert __package__
+
+ffibuilder = cffi.FFI()
+ffibuilder.cdef(
+    '''
+    int av_aes_init(
+        uint8_t *a,
+        const uint8_t *key,
+        int key_bits,
+        int decrypt
+    );
+
+    void av_aes_crypt(
+        uint8_t *a,
+        uint8_t *dst,
+        const uint8_t *src,
+        int count,
+        uint8_t *iv,
+        int decrypt
+    );
+    ''',
+)
+ffibuilder.set_source(f'{__package__}._avutil', None)
+
+if __name__ == '__main__':
+    ffibuilder.compile(os.path.join(os.path.dirname(__file__), '..'))
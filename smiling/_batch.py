@@ -0,0 +1,155 @@
+__all__ = ('run',)
+
+import asyncio
+from collections.abc import Callable
+from collections.abc import Coroutine
+from collections.abc import Sequence
+import contextlib
+import logging
+from typing import Any
+
+from . import _downloader
+from . import _main
+from . import _metrics
+from ._types import Format
+
+type _Segments = asyncio.Queue[memoryview | Exception | None]
+
+
+async def run(
+    ids: Sequence[str],
+    format_: Format,
+    tracks: int,
+    /,
+    *,
+    start: float | None = None,
+    end: float | None = None,
+):
+    """Download many audios through a metadata, fetch and mux pipeline.
+
+    Each stage has its own workers and a bounded queue in front of it, so
+    the next tracks' metadata round trips and the previous tracks' muxing
+    overlap with segment transfer. At most `tracks` tracks fetch segments
+    at a time. Failures are collected per ID instead of aborting the batch.
+    `start` and `end` clip every audio to the same window.
+    """
+    states = _main.states.get()
+    settings = states['settings']
+    results: dict[str, str | Exception] = {}
+    it = iter(ids)
+    n_metadata = min(settings.metadata_workers, len(ids))
+    n_fetch = min(tracks, len(ids))
+    n_mux = min(settings.mux_workers, len(ids))
+    resolved: asyncio.Queue[
+        tuple[_metrics.Trace, _downloader.Track] | None
+    ] = asyncio.Queue(n_fetch)
+    fetched: asyncio.Queue[
+        tuple[
+            _metrics.Trace,
+            _downloader.Track,
+            _Segments,
+            asyncio.Task[None],
+        ] | None
+    ] = asyncio.Queue(n_mux)
+
+    def done(trace: _metrics.Trace, result: str | Exception):
+        results[trace.id] = result
+        trace.finish('failed' if isinstance(result, Exception) else 'done')
+        states['metrics'].add(trace)
+        if isinstance(result, Exception):
+            _logger.error(
+                '[%d/%d] %s: %r',
+                len(results),
+                len(ids),
+                trace.id,
+                result,
+            )
+        else:
+            _logger.info(
+                '[%d/%d] %s: %s',
+                len(results),
+                len(ids),
+                trace.id,
+                result,
+            )
+
+    async def metadata():
+        for id_ in it:
+            trace = _metrics.Trace(id_, format_)
+            try:
+                with _metrics.tracing(trace):
+                    track = await _downloader.resolve(
+                        id_,
+                        format_,
+                        start=start,
+                        end=end,
+                    )
+            except Exception as e:
+                done(trace, e)
+                continue
+            if isinstance(track, _downloader.Track):
+                await resolved.put((trace, track))
+            else:
+                done(trace, track)
+
+    async def fetch():
+        while item := await resolved.get():
+            trace, track = item
+            segments: _Segments = asyncio.Queue(_BUFFER)
+            with _metrics.tracing(trace):
+                task = asyncio.create_task(_pump(track, segments))
+            await fetched.put((trace, track, segments, task))
+            await asyncio.wait([task])
+
+    async def mux():
+        while item := await fetched.get():
+            trace, track, segments, task = item
+            try:
+                with _metrics.tracing(trace):
+                    result = await _downloader.finish(track, _drain(segments))
+            except Exception as e:
+                task.cancel()  # Unblock the fetch worker
+                result = e
+            done(trace, result)
+
+    async def stage(
+        worker: Callable[[], Coroutine[Any, Any, None]],
+        n: int,
+        downstream: asyncio.Queue[Any],
+        n_downstream: int,
+    ):
+        async with asyncio.TaskGroup() as tg:
+            for _ in range(n):
+                tg.create_task(worker())
+        for _ in range(n_downstream):
+            await downstream.put(None)
+
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(stage(metadata, n_metadata, resolved, n_fetch))
+        tg.create_task(stage(fetch, n_fetch, fetched, n_mux))
+        for _ in range(n_mux):
+            tg.create_task(mux())
+    return results
+
+
+async def _drain(segments: _Segments, /):
+    while (segment := await segments.get()) is not None:
+        if isinstance(segment, Exception):
+            raise segment
+        yield segment
+
+
+async def _pump(track: _downloader.Track, segments: _Segments, /):
+    """Fetch the segments of `track` into a queue, ending with None."""
+    try:
+        async with contextlib.aclosing(_downloader.fetch(track)) as it:
+            async for segment in it:
+                await segments.put(segment)
+    except Exception as e:
+        await segments.put(e)
+    else:
+        await segments.put(None)
+
+
+_BUFFER = 64  # Decrypted segments queued per track
+_logger = logging.getLogger(__package__)
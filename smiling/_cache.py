@@ -0,0 +1,147 @@
+__all__ = ('SegmentCache', 'TTLCache')
+
+import asyncio
+import collections
+import concurrent.futures
+import os
+import shutil
+import time
+
+
+class SegmentCache:
+    """Size-bounded LRU cache of encrypted segments on disk.
+
+    Entries live at `{video ID}/{audio source ID}/{index}` under the cache
+    directory, so an interrupted download only refetches what is missing.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        max_size: int,
+        executor: concurrent.futures.Executor,
+    ):
+        self._cache_dir = cache_dir
+        self._executor = executor
+        self._max_size = max_size
+        self._size = 0
+        self._entries: collections.OrderedDict[str, int] = (
+            collections.OrderedDict()
+        )
+        entries: list[tuple[float, str, int]] = []
+        for root, _dirs, files in os.walk(cache_dir):
+            for file in files:
+                fullname = os.path.join(root, file)
+                if file.endswith('.tmp'):
+                    os.remove(fullname)  # Interrupted write
+                    continue
+                st = os.stat(fullname)
+                name = os.path.relpath(fullname, cache_dir)
+                entries.append((st.st_mtime, name, st.st_size))
+        for _mtime, name, size in sorted(entries):
+            self._entries[name] = size
+            self._size += size
+        self._evict()
+
+    def discard(self, id_: str, source: str, /):
+        """Drop every entry of a track, e.g. once it has been written."""
+        prefix = os.path.join(id_, source, '')
+        for name in [k for k in self._entries if k.startswith(prefix)]:
+            self._size -= self._entries.pop(name)
+        shutil.rmtree(
+            os.path.join(self._cache_dir, id_, source),
+            ignore_errors=True,
+        )
+
+    async def get(self, id_: str, source: str, index: int | str, /):
+        name = os.path.join(id_, source, str(index))
+        if name not in self._entries:
+            return None
+        self._entries.move_to_end(name)
+        loop = asyncio.get_running_loop()
+        fullname = os.path.join(self._cache_dir, name)
+        try:
+            return await loop.run_in_executor(self._executor, _read, fullname)
+        except OSError:
+            if (size := self._entries.pop(name, None)) is not None:
+                self._size -= size
+            return None
+
+    async def put(
+        self,
+        id_: str,
+        source: str,
+        index: int | str,
+        content: bytes | bytearray,
+        /,
+    ):
+        if len(content) > self._max_size:
+            return
+        name = os.path.join(id_, source, str(index))
+        loop = asyncio.get_running_loop()
+        fullname = os.path.join(self._cache_dir, name)
+        await loop.run_in_executor(self._executor, _write, fullname, content)
+        self._size += len(content) - self._entries.pop(name, 0)
+        self._entries[name] = len(content)
+        self._evict()
+
+    def _evict(self):
+        while self._size > self._max_size:
+            name, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(os.path.join(self._cache_dir, name))
+            except OSError:
+                pass
+
+
+class TTLCache[K, V]:
+    """Size-bounded in-memory LRU cache whose entries expire after `ttl`.
+
+    A `ttl` of 0 turns the cache off.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self._entries: collections.OrderedDict[K, tuple[float, V]] = (
+            collections.OrderedDict()
+        )
+        self._max_size = max_size
+        self._ttl = ttl
+
+    def discard(self, key: K, /):
+        self._entries.pop(key, None)
+
+    def get(self, key: K, /) -> V | None:
+        if (entry := self._entries.get(key)) is None:
+            return None
+        expire, value = entry
+        if expire <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: K, value: V, /):
+        if not self._ttl:
+            return
+        self._entries[key] = time.monotonic() + self._ttl, value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+
+def _read(fullname: str, /):
+    # Writable, so that segments decrypt in place like fetched ones
+    with open(fullname, 'rb') as f:
+        content = bytearray(os.fstat(f.fileno()).st_size)
+        del content[f.readinto(content):]
+    os.utime(fullname)  # Keep the LRU order across restarts
+    return content
+
+
+def _write(fullname: str, content: bytes | bytearray, /):
+    os.makedirs(os.path.dirname(fullname), exist_ok=True)
+    tmp = f'{fullname}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, fullname)
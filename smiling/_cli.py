@@ -5,8 +5,6 @@ from typing import Annotated
 import pydantic
 import pydantic_settings
 
-from . import _main
-from . import _parser
 from ._types import Format
 
 
@@ -17,21 +15,46 @@ def main():
 class _Main(pydantic_settings.BaseSettings):
     """Download audio and play it.
 
+    If several audios are given, download them all without playing.
     If invoked without any command-line arguments, launch a server instead.
     """
 
     audio: Annotated[
-        pydantic_settings.CliPositionalArg[str],
+        pydantic_settings.CliPositionalArg[list[str]],
         pydantic.Field(
-            description='URL or sm-number of the audio to download',
-            min_length=3,
-            pattern=_parser.pattern,
+            description=(
+                'URLs or sm-numbers of the audio to download, '
+                '@FILE to read them from a file, or - to read them from stdin'
+            ),
+            min_length=1,
         ),
     ]
     format_: Annotated[
         Format,
         pydantic.Field(alias='f', description='Audio format'),
     ] = 'worst'
+    start: Annotated[
+        pydantic.NonNegativeFloat | None,
+        pydantic.Field(description='Seconds into the audio to start at'),
+    ] = None
+    end: Annotated[
+        pydantic.PositiveFloat | None,
+        pydantic.Field(description='Seconds into the audio to stop at'),
+    ] = None
+    progressive: Annotated[
+        bool,
+        pydantic.Field(
+            alias='p',
+            description='Start playing before the download finishes',
+        ),
+    ] = False
+    tracks: Annotated[
+        pydantic.PositiveInt | None,
+        pydantic.Field(
+            alias='j',
+            description='Number of tracks downloaded at once in batch mode',
+        ),
+    ] = None
 
     model_config = pydantic_settings.SettingsConfigDict(
         nested_model_default_partial_update=True,
@@ -44,7 +67,16 @@ class _Main(pydantic_settings.BaseSettings):
     )
 
     def cli_cmd(self):
-        _main.cli_cmd(self.audio, self.format_)
+        from . import _main
+
+        _main.cli_cmd(
+            self.audio,
+            self.format_,
+            self.progressive,
+            self.tracks,
+            self.start,
+            self.end,
+        )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,350 @@
+__all__ = ('BACKENDS', 'Backend', 'Cipher', 'find_library', 'load')
+
+from collections.abc import Callable
+import ctypes.util
+import functools
+import glob
+import logging
+import os
+import struct
+import sys
+import threading
+from typing import cast
+from typing import Protocol
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import cffi
+
+    from ._types import Lib
+    from ._types import LibCrypto
+
+type Cipher = Callable[[bytearray], memoryview]
+
+
+class Backend(Protocol):
+    """AES-128-CBC decryption of whole segments.
+
+    Every segment starts from the same IV, so a cipher can decrypt
+    segments independently, in any order and from several threads. A
+    cipher decrypts in place and returns a view without the padding.
+    """
+
+    name: str
+
+    def cipher(self, key: bytes, iv: bytes, /) -> Cipher: ...
+
+    def close(self) -> None: ...
+
+
+def find_library(name: str, /):
+    """Find a shared library in the active environment, then the system."""
+    prefix = os.environ.get('CONDA_PREFIX', sys.prefix)
+    match sys.platform:
+        case 'win32':
+            patterns = [
+                rf'Library\bin\{name}-*.dll',
+                rf'Library\bin\lib{name}-*.dll',
+            ]
+        case 'darwin':
+            patterns = [f'lib/lib{name}.*.dylib']
+        case _:
+            patterns = [f'lib/lib{name}.so.*']
+    for pattern in patterns:
+        if found := sorted(glob.iglob(os.path.join(prefix, pattern))):
+            return found[0]
+    return ctypes.util.find_library(name)
+
+
+def load(name: str, /) -> Backend:
+    """Load a backend by name, or the first one that loads for 'auto'."""
+    if name != 'auto':
+        return BACKENDS[name]()
+    errors: list[str] = []
+    for backend in BACKENDS.values():
+        try:
+            loaded = backend()
+        except (ImportError, OSError) as e:
+            errors.append(f'{backend.__name__}: {e}')
+            continue
+        if loaded.name == 'python':
+            _logger.warning(
+                'Decrypting in pure Python, which is slow: %s',
+                '; '.join(errors),
+            )
+        return loaded
+    raise OSError(f'No AES backend available: {"; ".join(errors)}')
+
+
+class _Avutil:
+    name = 'avutil'
+
+    def __init__(self):
+        try:
+            from ._avutil import ffi
+        except ImportError:  # Not generated, parse the declarations instead
+            from ._avutil_build import ffibuilder as ffi
+        if not (libpath := find_library('avutil')):
+            raise OSError('libavutil not found')
+        self._ffi = ffi
+        self._dll = ffi.dlopen(libpath)
+        self._lib = cast('Lib', self._dll)
+
+    def cipher(self, key: bytes, iv: bytes, /):
+        ffi = self._ffi
+        lib = self._lib
+        local = threading.local()
+
+        def decrypt(segment: bytearray, /):
+            try:
+                a = local.a
+            except AttributeError:
+                a = local.a = ffi.new(
+                    'uint8_t[]',
+                    288  # sizeof(struct AVAES)
+                    + 16  # iv
+                )
+                err = lib.av_aes_init(a, key, 128, 1)
+                assert not err
+            iv_ = cast('cffi.FFI.CData', a + 288)
+            ffi.memmove(iv_, iv, 16)
+            with ffi.from_buffer(
+                'uint8_t[]',
+                segment,
+                require_writable=True,
+            ) as b:
+                lib.av_aes_crypt(a, b, b, len(segment)//16, iv_, 1)
+            return _unpad(segment)
+
+        return decrypt
+
+    def close(self):
+        self._ffi.dlclose(self._dll)
+
+
+class _OpenSSL:
+    name = 'openssl'
+
+    def __init__(self):
+        import cffi
+
+        if not (libpath := find_library('crypto')):
+            raise OSError('libcrypto not found')
+        ffi = cffi.FFI()
+        ffi.cdef(
+            '''
+            typedef struct evp_cipher_st EVP_CIPHER;
+            typedef struct evp_cipher_ctx_st EVP_CIPHER_CTX;
+
+            const EVP_CIPHER *EVP_aes_128_cbc(void);
+            EVP_CIPHER_CTX *EVP_CIPHER_CTX_new(void);
+            void EVP_CIPHER_CTX_free(EVP_CIPHER_CTX *ctx);
+            int EVP_CIPHER_CTX_set_padding(EVP_CIPHER_CTX *ctx, int pad);
+
+            int EVP_DecryptInit_ex(
+                EVP_CIPHER_CTX *ctx,
+                const EVP_CIPHER *type,
+                void *impl,
+                const unsigned char *key,
+                const unsigned char *iv
+            );
+
+            int EVP_DecryptUpdate(
+                EVP_CIPHER_CTX *ctx,
+                unsigned char *out,
+                int *outl,
+                const unsigned char *in,
+                int inl
+            );
+            ''',
+        )
+        self._ffi = ffi
+        self._dll = ffi.dlopen(libpath)
+        self._lib = cast('LibCrypto', self._dll)
+
+    def cipher(self, key: bytes, iv: bytes, /):
+        ffi = self._ffi
+        lib = self._lib
+        local = threading.local()
+        aes = lib.EVP_aes_128_cbc()
+
+        def decrypt(segment: bytearray, /):
+            try:
+                ctx = local.ctx
+            except AttributeError:
+                ctx = local.ctx = ffi.gc(
+                    lib.EVP_CIPHER_CTX_new(),
+                    lib.EVP_CIPHER_CTX_free,
+                )
+            # Reinitializing resets the IV
+            if not lib.EVP_DecryptInit_ex(ctx, aes, ffi.NULL, key, iv):
+                raise ValueError('EVP_DecryptInit_ex failed')
+            lib.EVP_CIPHER_CTX_set_padding(ctx, 0)
+            outl = ffi.new('int *')
+            with ffi.from_buffer(
+                'unsigned char[]',
+                segment,
+                require_writable=True,
+            ) as b:
+                if not lib.EVP_DecryptUpdate(ctx, b, outl, b, len(segment)):
+                    raise ValueError('EVP_DecryptUpdate failed')
+            return _unpad(segment)
+
+        return decrypt
+
+    def close(self):
+        self._ffi.dlclose(self._dll)
+
+
+class _Python:
+    """Table-driven AES in pure Python, slow but always available."""
+
+    name = 'python'
+
+    def cipher(self, key: bytes, iv: bytes, /):
+        rk = _decryption_keys(key)
+        td0, td1, td2, td3, si = _tables()
+        # Bytes of the inverse S-box shifted into each position of a word
+        s0, s1, s2 = (
+            [x << 24 for x in si],
+            [x << 16 for x in si],
+            [x << 8 for x in si],
+        )
+        last = rk[-4:]
+
+        def decrypt(segment: bytearray, /):
+            n = len(segment) // 4
+            words = struct.unpack(f'>{n}I', segment)
+            out = [0] * n
+            p0, p1, p2, p3 = struct.unpack('>4I', iv)
+            for i in range(0, n, 4):
+                c0, c1, c2, c3 = words[i:i+4]
+                a0: int = c0 ^ rk[0]
+                a1: int = c1 ^ rk[1]
+                a2: int = c2 ^ rk[2]
+                a3: int = c3 ^ rk[3]
+                for r in range(4, 40, 4):
+                    a0, a1, a2, a3 = (
+                        td0[a0 >> 24] ^ td1[a3 >> 16 & 255]
+                        ^ td2[a2 >> 8 & 255] ^ td3[a1 & 255] ^ rk[r],
+                        td0[a1 >> 24] ^ td1[a0 >> 16 & 255]
+                        ^ td2[a3 >> 8 & 255] ^ td3[a2 & 255] ^ rk[r+1],
+                        td0[a2 >> 24] ^ td1[a1 >> 16 & 255]
+                        ^ td2[a0 >> 8 & 255] ^ td3[a3 & 255] ^ rk[r+2],
+                        td0[a3 >> 24] ^ td1[a2 >> 16 & 255]
+                        ^ td2[a1 >> 8 & 255] ^ td3[a0 & 255] ^ rk[r+3],
+                    )
+                out[i] = (
+                    s0[a0 >> 24] | s1[a3 >> 16 & 255]
+                    | s2[a2 >> 8 & 255] | si[a1 & 255]
+                ) ^ last[0] ^ p0
+                out[i+1] = (
+                    s0[a1 >> 24] | s1[a0 >> 16 & 255]
+                    | s2[a3 >> 8 & 255] | si[a2 & 255]
+                ) ^ last[1] ^ p1
+                out[i+2] = (
+                    s0[a2 >> 24] | s1[a1 >> 16 & 255]
+                    | s2[a0 >> 8 & 255] | si[a3 & 255]
+                ) ^ last[2] ^ p2
+                out[i+3] = (
+                    s0[a3 >> 24] | s1[a2 >> 16 & 255]
+                    | s2[a1 >> 8 & 255] | si[a0 & 255]
+                ) ^ last[3] ^ p3
+                p0, p1, p2, p3 = c0, c1, c2, c3
+            struct.pack_into(f'>{n}I', segment, 0, *out)
+            return _unpad(segment)
+
+        return decrypt
+
+    def close(self):
+        pass
+
+
+def _decryption_keys(key: bytes, /):
+    """Expand a key into round keys for the equivalent inverse cipher."""
+    td0, td1, td2, td3, _ = _tables()
+    sbox = _SBOX
+    w = list(struct.unpack('>4I', key))
+    rcon = 1
+    for i in range(4, 44):
+        t = w[i-1]
+        if not i % 4:
+            t = (
+                sbox[t >> 16 & 255] << 24 | sbox[t >> 8 & 255] << 16
+                | sbox[t & 255] << 8 | sbox[t >> 24]
+            ) ^ rcon << 24
+            rcon = _xtime(rcon)
+        w.append(w[i-4] ^ t)
+    rk = w[40:44]
+    for r in range(9, 0, -1):
+        for t in w[4*r:4*r+4]:
+            # Td[S[x]] is InvMixColumns applied to x
+            rk.append(
+                td0[sbox[t >> 24]] ^ td1[sbox[t >> 16 & 255]]
+                ^ td2[sbox[t >> 8 & 255]] ^ td3[sbox[t & 255]],
+            )
+    return rk + w[:4]
+
+
+@functools.cache
+def _tables():
+    si = [0] * 256
+    for x, s in enumerate(_SBOX):
+        si[s] = x
+    td0 = [
+        _mul(s, 14) << 24 | _mul(s, 9) << 16 | _mul(s, 13) << 8
+        | _mul(s, 11)
+        for s in si
+    ]
+    td1 = [(t >> 8 | t << 24) & 0xffffffff for t in td0]
+    td2 = [(t >> 8 | t << 24) & 0xffffffff for t in td1]
+    td3 = [(t >> 8 | t << 24) & 0xffffffff for t in td2]
+    return td0, td1, td2, td3, si
+
+
+def _mul(a: int, b: int, /):
+    """Multiply in GF(2^8)."""
+    p = 0
+    while b:
+        if b & 1:
+            p ^= a
+        a = _xtime(a)
+        b >>= 1
+    return p
+
+
+def _sbox():
+    sbox = [0x63] * 256
+    p = q = 1
+    while True:
+        p = p ^ (p << 1) ^ (0x1b if p & 0x80 else 0)  # Multiply by 3
+        p &= 0xff
+        for shift in (1, 2, 4):  # Divide by 3
+            q ^= q << shift
+        q &= 0xff
+        if q & 0x80:
+            q ^= 0x09
+        x = q
+        for shift in (1, 2, 3, 4):
+            x ^= (q << shift | q >> (8 - shift)) & 0xff
+        sbox[p] = x ^ 0x63
+        if p == 1:
+            return sbox
+
+
+def _unpad(buf: bytearray, /):
+    return memoryview(buf)[:len(buf)-buf[-1]]
+
+
+def _xtime(a: int, /):
+    a <<= 1
+    return (a ^ 0x11b) if a & 0x100 else a
+
+
+BACKENDS: dict[str, Callable[[], Backend]] = {  # Fastest first
+    'openssl': _OpenSSL,  # AES-NI where the CPU has it
+    'avutil': _Avutil,
+    'python': _Python,
+}
+_SBOX = _sbox()
+_logger = logging.getLogger(__package__)
@@ -1,7 +1,24 @@
-__all__ = ('download', 'prepare')
+__all__ = (
+    'Source',
+    'Spool',
+    'Track',
+    'download',
+    'fetch',
+    'finish',
+    'prepare',
+    'prewarm',
+    'resolve',
+)
 
 import asyncio
+import bisect
+import collections
+from collections.abc import AsyncGenerator
 from collections.abc import Iterable
+import contextlib
+import contextvars
+import hashlib
+import itertools
 import json
 import logging
 import math
@@ -10,9 +27,12 @@ import os
 import random
 import socket
 import ssl
+import statistics
 import subprocess
+import tempfile
 import time
 from typing import Any
+from typing import NamedTuple
 from typing import override
 
 import httpcore2 as httpcore
@@ -21,116 +41,455 @@ import pydantic
 from urllib3.util import ssl_match_hostname
 
 from . import _main
+from . import _metrics
+from . import _mp4
 from . import _parser
+from ._crypto import Cipher
+from ._endpoints import Endpoints
+from ._endpoints import Front
+from ._limiter import Lease
 from ._types import Domand
+from ._types import DomandItem
 from ._types import EventHooks
 from ._types import Format
 from ._types import HLS
+from ._types import M3U8
+from ._types import Playlist
+from ._types import Settings
 
 
-async def download(id_: str, format_: Format, /) -> str:
+async def download(
+    id_: str,
+    format_: Format,
+    /,
+    *,
+    spool: Spool | None = None,
+    start: float | None = None,
+    end: float | None = None,
+) -> str:
+    """Download audio, also feeding the decrypted stream to `spool`.
+
+    Only the segments overlapping the window from `start` to `end`
+    seconds are fetched when either is given.
+    """
+    trace = _metrics.Trace(id_, format_)
+    status = 'failed'
+    try:
+        with _metrics.tracing(trace):
+            track = await resolve(id_, format_, start=start, end=end)
+            if isinstance(track, Track):
+                track = await finish(track, fetch(track), spool)
+        status = 'done'
+        return track
+    finally:
+        if spool:
+            spool.close()
+        trace.finish(status)
+        _main.states.get()['metrics'].add(trace)
+
+
+def fetch(track: Track, /):
+    """Yield the decrypted segments of `track` in order."""
+    client = _main.states.get()['client']
+    return _m3u8_segments(
+        client,
+        (track.id, track.audio.id),
+        track.decrypt,
+        track.access,
+        track.segments,
+        track.lease,
+    )
+
+
+async def finish(
+    track: Track,
+    segments: AsyncGenerator[memoryview],
+    spool: Spool | None = None,
+    /,
+) -> str:
+    """Mux `segments` of `track` into its output file and index it.
+
+    A clip is cut out of its segments instead, and neither indexed nor
+    dropped from the segment cache.
+    """
     states = _main.states.get()
-    prefix = '' if format_ == 'best' else '_'
-    output_file = os.path.join(states['output_dir'], f'{prefix}{id_}.m4a')
-    transport = httpx.AsyncHTTPTransport(retries=42)
-    transport._pool._network_backend = states['network_backend']  # pyright: ignore[reportPrivateUsage]
-    async with httpx.AsyncClient(
-        event_hooks=states['event_hooks'],
-        follow_redirects=True,
-        headers={'User-Agent': _user_agent()},
-        timeout=60,
-        transport=transport,
-    ) as client:
-        response = await client.get(f'https://www.nicovideo.jp/watch/{id_}')
-        try:
-            root = _parser.parse_html(response.text)
-            if dms := root.media.domand:
-                assert root.video.id == id_
-                response = await client.post(
-                    f'https://nvapi.nicovideo.jp/v1/watch/{id_}/access-rights/hls',
-                    json=_dms_json(dms, format_),
-                    params={'actionTrackId': root.client.watchTrackId},
-                    headers={
-                        'X-Access-Right-Key': dms.accessRightKey,
-                        'X-Frontend-Id': '6',
-                        'X-Frontend-Version': '0',
-                        'X-Request-With': 'https://www.nicovideo.jp',
-                    },
+    try:
+        with _temporary(track.output_file) as muxed:
+            await _m3u8_concat(
+                track.id,
+                muxed,
+                spool,
+                track.header,
+                _written(segments, track.lease),
+            )
+            if track.trim is None:
+                os.replace(muxed, track.output_file)
+                await _index(
+                    track.id,
+                    track.format,
+                    track.audio.qualityLevel,
+                    track.output_file,
+                    track.duration,
                 )
-                hls = HLS.model_validate_json(response.text).data
-                async with asyncio.timeout(
-                    hls.expireTime.timestamp() - time.time(),
-                ):
-                    response = await client.get(hls.contentUrl)
-                    url = _parser.parse_m3u8(response.text).media[0].uri
-                    response = await client.get(url)
-                    m3u8 = _parser.parse_m3u8(response.text)
-                    if format_ == 'best':
-                        stop = None
-                    else:
-                        assert m3u8.targetduration
-                        stop = math.ceil(120 / m3u8.targetduration)
-                    args = await asyncio.gather(
-                        _m3u8_header(client, m3u8.segment_map[0].uri),
-                        _m3u8_key(client, m3u8.keys[0].uri),
-                        *[
-                            _m3u8_segment(client, segment.uri)
-                            for segment in m3u8.segments[:stop]
-                        ],
-                    )
-                iv = m3u8.keys[0].iv.to_bytes(16)
-                await _m3u8_concat(id_, output_file, iv, *args)
             else:
-                raise NotImplementedError()
-        except Exception as e:
-            if not isinstance(e, httpx.HTTPStatusError):
-                t = time.strftime('%Y%m%d%H%M%S')
-                if content_type := response.headers.get('Content-Type'):
-                    ext = mimetypes.guess_extension(content_type) or ''
-                else:
-                    ext = ''
-                fullname = os.path.join(states['log_dir'], f'{id_}-{t}{ext}')
-                with open(fullname, 'w', encoding='utf-8') as f:
-                    f.write(response.text)
-                _logger.exception(
-                    'Failed to download %s, see %s for details',
-                    id_,
-                    fullname,
-                )
-            raise
-        return output_file
+                with _metrics.phase('trim'):
+                    await _trim(muxed, track.output_file, *track.trim)
+    except Exception as e:
+        states['sources'].discard((track.id, track.format))
+        if track.access.response and not isinstance(e, httpx.HTTPStatusError):
+            _dump(track.id, track.access.response)
+        raise
+    finally:
+        track.lease.close()
+    if track.trim is None:
+        # A clip leaves the rest, kept to resume a full download
+        states['cache'].discard(track.id, track.audio.id)
+    return track.output_file
+
 
+def prepare(settings: Settings):
+    hosts = {k: _listed(v) for k, v in settings.hosts.items()}
+    sni_hostname = {k: _listed(v) for k, v in settings.sni_hostname.items()}
 
-def prepare(hosts: dict[str, str], sni_hostname: dict[str, str]):
     async def event_hook(request: httpx.Request):
         url = request.url
         host = url.host
         if host in hosts:
             # https://httpx2.pydantic.dev/advanced/extensions/#sni_hostname
-            request.extensions['sni_hostname'] = sni_hostname.get(host, host)
+            # The stream accepts a certificate for any of the names
+            names = sni_hostname.get(host, [host])
+            request.extensions['sni_hostname'] = names[0]
             request.headers['Host'] = host
-        if _logger.isEnabledFor(logging.DEBUG):
-            url = str(url)
+        debug = _logger.isEnabledFor(logging.DEBUG)
+        url = str(url)
 
-            async def trace(event_name: str, _info: dict[str, Any], /):
+        async def trace(event_name: str, _info: dict[str, Any], /):
+            match event_name.rpartition('.'):
+                case 'connection.connect_tcp', _, 'complete':
+                    _metrics.count('connections')
+                case 'connection.connect_tcp', _, 'failed':
+                    _metrics.count('connect_retries')
+                case (
+                    'http11.send_request_headers'
+                    | 'http2.send_request_headers',
+                    _,
+                    'started',
+                ):
+                    _metrics.count('requests')
+                case _:
+                    pass
+            if debug:
                 pair = (host, event_name)
                 if pair not in seen:
                     seen.add(pair)
                     _logger.debug('%s: %s', event_name, url)
 
-            request.extensions['trace'] = trace
+        request.extensions['trace'] = trace
 
     seen: set[tuple[str, str]] = set()
     event_hooks: EventHooks = {
         'request': [event_hook],
         'response': [_event_hook],
     }
-    return event_hooks, _AsyncIOBackend(hosts)
+    verify = _TLSContext(ssl.PROTOCOL_TLS_CLIENT)
+    verify.verify_flags |= ssl.VERIFY_X509_PARTIAL_CHAIN
+    verify.verify_flags |= ssl.VERIFY_X509_STRICT
+    if settings.cafile:
+        verify.load_verify_locations(settings.cafile)
+    else:
+        verify.load_default_certs()
+    transport = httpx.AsyncHTTPTransport(
+        limits=httpx.Limits(
+            max_connections=settings.max_connections,
+            max_keepalive_connections=settings.max_connections,
+            keepalive_expiry=settings.keepalive_expiry,
+        ),
+        retries=42,
+        verify=verify,
+    )
+    transport._pool._network_backend = _AsyncIOBackend(  # pyright: ignore[reportPrivateUsage]
+        Endpoints(hosts),
+        sni_hostname,
+    )
+    return httpx.AsyncClient(
+        event_hooks=event_hooks,
+        follow_redirects=True,
+        headers={'User-Agent': _user_agent()},
+        timeout=60,
+        transport=_HostLimits(transport, settings.max_connections_per_host),
+    )
+
+
+async def prewarm(client: httpx.AsyncClient, settings: Settings):
+    """Open `settings.prewarm` idle connections to each remapped host.
+
+    Any response will do: it leaves a handshaken connection in the pool
+    and a TLS session to resume.
+    """
+
+    async def touch(host: str):
+        try:
+            await client.head(f'https://{host}/')
+        except httpx.HTTPError as e:
+            _logger.debug('Prewarming %s: %r', host, e)
+
+    async with asyncio.TaskGroup() as tg:
+        for host in settings.hosts:
+            for _ in range(settings.prewarm):
+                tg.create_task(touch(host))
+
+
+async def resolve(
+    id_: str,
+    format_: Format,
+    /,
+    *,
+    start: float | None = None,
+    end: float | None = None,
+) -> str | Track:
+    """Return the file if already downloaded, or fetch the metadata.
+
+    Giving `start` or `end` in seconds asks for a clip of the audio, cut
+    from the 'best' download if there is one. Clips are not indexed.
+    """
+    clip = start is not None or end is not None
+    start = start or 0
+    if end is not None and end <= start:
+        raise ValueError('Empty time window')
+    states = _main.states.get()
+    library = states['library']
+    if not clip and (entry := library.get(id_, format_)):
+        _metrics.count('library_hits')
+        return entry[0]
+    stem = id_ if format_ == 'best' else f'_{id_}'
+    if clip:
+        stem += f'_{start:g}-' + ('' if end is None else f'{end:g}')
+    output_file = os.path.join(states['output_dir'], f'{stem}.m4a')
+    if (clip or format_ != 'best') and (entry := library.get(id_, 'best')):
+        fullname, quality, duration = entry
+        if start >= duration:
+            raise ValueError('Time window outside the track')
+        with _metrics.phase('trim'):
+            if clip:
+                await _trim(
+                    fullname,
+                    output_file,
+                    start,
+                    None if end is None else end - start,
+                )
+                return output_file
+            await _trim(fullname, output_file, 0, _PREVIEW)
+        await _index(
+            id_,
+            format_,
+            quality,
+            output_file,
+            min(duration, _PREVIEW),
+        )
+        return output_file
+    sources = states['sources']
+    if (source := sources.get((id_, format_))) is None:
+        source = await _source(id_, format_)
+        sources.put((id_, format_), source)
+    else:
+        _metrics.count('rights_cache_hits')
+    try:
+        m3u8 = await source.access.playlist()  # Renewed if about to expire
+    except Exception:
+        sources.discard((id_, format_))
+        raise
+    trim = None
+    if clip:
+        indexes, offset = _m3u8_window(m3u8, start, end)
+        trim = offset, None if end is None else end - start
+    elif format_ == 'best':
+        indexes = range(len(m3u8.segments))
+    else:
+        assert m3u8.targetduration
+        stop = math.ceil(_PREVIEW / m3u8.targetduration)
+        indexes = range(min(stop, len(m3u8.segments)))
+    segments = m3u8.segments[indexes.start:indexes.stop]
+    return Track(
+        id=id_,
+        format=format_,
+        output_file=output_file,
+        access=source.access,
+        audio=source.audio,
+        header=source.header,
+        decrypt=states['aes'].cipher(
+            source.key,
+            m3u8.keys[0].iv.to_bytes(16),
+        ),
+        lease=states['memory'].lease(),
+        segments=indexes,
+        duration=sum(segment.duration for segment in segments),
+        trim=trim,
+    )
+
+
+class Source(NamedTuple):
+    """Metadata of a track, kept for repeat downloads while it is valid."""
+
+    access: _Access
+    audio: DomandItem
+    header: bytes
+    key: bytes
+
+
+class Spool:
+    """Temporary file that a player follows while the download grows it."""
+
+    def __init__(self):
+        fd, self._fullname = tempfile.mkstemp(
+            suffix='.mp4',
+            prefix=f'{__package__}-',
+        )
+        self._file = os.fdopen(fd, 'wb')
+        self._grown = asyncio.Event()
+        self._size = 0
+        self.ready = asyncio.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info: object):
+        self.close()
+        os.remove(self._fullname)
+
+    @property
+    def empty(self):
+        return not self._size
+
+    def close(self):
+        self._file.close()
+        self._grown.set()
+        self.ready.set()
+
+    async def follow(self, writer: asyncio.StreamWriter):
+        """Copy the spool to `writer` until the download closes it."""
+        with open(self._fullname, 'rb') as f:
+            while True:
+                self._grown.clear()
+                if chunk := f.read(1 << 16):
+                    writer.write(chunk)
+                    await writer.drain()
+                elif self._file.closed:
+                    break
+                else:
+                    await self._grown.wait()
+
+    def write(self, data: bytes | memoryview, /):
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+        self._grown.set()
+        self.ready.set()
+
+
+class Track(NamedTuple):
+    """A track with its metadata fetched, ready for its segments."""
+
+    id: str
+    format: Format
+    output_file: str
+    access: _Access
+    audio: DomandItem
+    header: bytes
+    decrypt: Cipher
+    lease: Lease
+    segments: range
+    duration: float
+    trim: tuple[float, float | None] | None  # Offset and duration of a clip
+
+
+class _Access:
+    """Access rights to the HLS playlist of a track.
+
+    The rights are renewed with the same Domand data shortly before they
+    expire, or when a segment URL is refused, so long downloads carry on
+    with fresh URLs instead of failing.
+    """
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        id_: str,
+        dms: Domand,
+        audio: DomandItem,
+        watch_track_id: str,
+    ):
+        self._audio = audio
+        self._client = client
+        self._dms = dms
+        self._expire = 0.0
+        self._id = id_
+        self._lock = asyncio.Lock()
+        self._margin = 0.0  # Seconds before expiry to renew
+        self._playlist: M3U8 | Playlist | None = None
+        self._watch_track_id = watch_track_id
+        self.response: httpx.Response | None = None
+
+    async def playlist(self, stale: M3U8 | Playlist | None = None):
+        """Return the media playlist, renewing it if it is `stale`."""
+        if self._renew(stale):
+            async with self._lock:
+                if self._renew(stale):
+                    await self._refresh()
+        assert self._playlist
+        return self._playlist
+
+    async def _refresh(self):
+        client = self._client
+        dms = self._dms
+        if self._playlist:
+            _metrics.count('renewals')
+        with _metrics.phase('access_rights'):
+            self.response = await client.post(
+                'https://nvapi.nicovideo.jp/v1/watch/'
+                f'{self._id}/access-rights/hls',
+                json=_dms_json(dms, self._audio),
+                params={'actionTrackId': self._watch_track_id},
+                headers={
+                    'X-Access-Right-Key': dms.accessRightKey,
+                    'X-Frontend-Id': '6',
+                    'X-Frontend-Version': '0',
+                    'X-Request-With': 'https://www.nicovideo.jp',
+                },
+            )
+        hls = HLS.model_validate_json(self.response.text).data
+        strict = _main.states.get()['settings'].strict_m3u8
+        with _metrics.phase('playlists'):
+            self.response = await client.get(hls.contentUrl)
+            master = _parser.parse_m3u8(self.response.text, strict=strict)
+            self.response = await client.get(master.media[0].uri)
+            playlist = _parser.parse_m3u8(self.response.text, strict=strict)
+        if self._playlist:
+            if len(playlist.segments) != len(self._playlist.segments):
+                raise ValueError('Segments changed on renewal')
+            _logger.info('Renewed access rights to %s', self._id)
+        self._playlist = playlist
+        self._expire = hls.expireTime.timestamp()
+        # Short-lived rights would otherwise look expiring from the start
+        lifetime = self._expire - hls.createTime.timestamp()
+        self._margin = min(_RENEW_MARGIN, lifetime / 2)
+
+    def _renew(self, stale: M3U8 | Playlist | None, /):
+        return (
+            self._playlist is None
+            or self._playlist is stale
+            or self._expire - time.time() < self._margin
+        )
 
 
 class _AsyncIOBackend(httpcore.AsyncNetworkBackend):
-    def __init__(self, hosts: dict[str, str]):
-        self._hosts = hosts
+    def __init__(
+        self,
+        endpoints: Endpoints,
+        sni_hostname: dict[str, list[str]],
+    ):
+        self._endpoints = endpoints
+        self._sni_hostname = sni_hostname
+        self._sessions: dict[str, ssl.SSLSession] = {}  # By target
 
     @override
     async def connect_tcp(
@@ -141,11 +500,25 @@ class _AsyncIOBackend(httpcore.AsyncNetworkBackend):
         local_address: str | None = None,
         socket_options: Iterable[httpcore.SOCKET_OPTION] | None = None,
     ):
-        host = self._hosts.get(host, host)
-        reader, writer = await asyncio.wait_for(
-            asyncio.open_connection(host, port, local_addr=local_address),
-            timeout,
-        )
+        names = self._sni_hostname.get(host, [])
+        front = None
+        with _mapped(httpcore.ConnectTimeout, httpcore.ConnectError):
+            if host in self._endpoints:
+                reader, writer, front = await asyncio.wait_for(
+                    self._endpoints.connect(host, port, local_address),
+                    timeout,
+                )
+                host = front.hostname
+                port = front.port or port
+            else:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(
+                        host,
+                        port,
+                        local_addr=local_address,
+                    ),
+                    timeout,
+                )
         if socket_options:
             sock: socket.socket = writer.get_extra_info('socket')
             for option in socket_options:
@@ -153,7 +526,14 @@ class _AsyncIOBackend(httpcore.AsyncNetworkBackend):
                     sock.setsockopt(*option)
                 else:
                     sock.setsockopt(*option)
-        return _AsyncIOStream(reader, writer)
+        return _AsyncIOStream(
+            reader,
+            writer,
+            self._sessions,
+            f'{host}:{port}',
+            front,
+            names,
+        )
 
     @override
     def sleep(self, seconds: float):
@@ -165,21 +545,49 @@ class _AsyncIOStream(httpcore.AsyncNetworkStream):
         self,
         reader: asyncio.StreamReader,
         writer: asyncio.StreamWriter,
+        sessions: dict[str, ssl.SSLSession],
+        target: str,
+        front: Front | None,
+        names: list[str],
     ):
+        self._front = front
+        self._names = names  # Accepted in the certificate, if any
+        self._read_seconds = 0.0
+        self._read_size = 0
         self._reader = reader
+        self._saved = False  # Whether the session with a ticket is saved
+        self._sessions = sessions
+        self._target = target
         self._writer = writer
 
     @override
-    def read(self, max_bytes: int, timeout: float | None = None):
-        return asyncio.wait_for(self._reader.read(max_bytes), timeout)
+    async def read(self, max_bytes: int, timeout: float | None = None):
+        start = time.monotonic()
+        with _mapped(httpcore.ReadTimeout, httpcore.ReadError):
+            data = await asyncio.wait_for(
+                self._reader.read(max_bytes),
+                timeout,
+            )
+        if data and not self._saved:
+            self._save_session()  # TLS 1.3 tickets arrive after the handshake
+        if self._front and data:
+            self._read_seconds += time.monotonic() - start
+            self._read_size += len(data)
+            if self._read_size >= _THROUGHPUT_SAMPLE:
+                self._observe_read()
+        return data
 
     @override
-    def write(self, buffer: bytes, timeout: float | None = None):
-        self._writer.write(buffer)
-        return asyncio.wait_for(self._writer.drain(), timeout)
+    async def write(self, buffer: bytes, timeout: float | None = None):
+        with _mapped(httpcore.WriteTimeout, httpcore.WriteError):
+            self._writer.write(buffer)
+            await asyncio.wait_for(self._writer.drain(), timeout)
 
     @override
     async def aclose(self):
+        self._observe_read()
+        if not self._saved:
+            self._save_session()
         self._writer.close()
         try:
             await self._writer.wait_closed()
@@ -193,27 +601,150 @@ class _AsyncIOStream(httpcore.AsyncNetworkStream):
         server_hostname: str | None = None,
         timeout: float | None = None,
     ):
-        await self._writer.start_tls(
-            ssl_context,
-            server_hostname='',  # Bypass SNI RST
-            ssl_handshake_timeout=timeout,
-            ssl_shutdown_timeout=timeout,
-        )
-        peercert = self._writer.get_extra_info('peercert')
-        if server_hostname:
-            ssl_match_hostname.match_hostname(peercert, server_hostname)
+        # httpcore never closes a stream whose handshake failed
+        try:
+            with _mapped(httpcore.ConnectTimeout, httpcore.ConnectError):
+                await self._start_tls(ssl_context, server_hostname, timeout)
+        except BaseException:
+            await self.aclose()
+            raise
         return self
 
     @override
     def get_extra_info(self, info: str):
         return self._writer.get_extra_info(info)
 
+    async def _start_tls(
+        self,
+        ssl_context: ssl.SSLContext,
+        server_hostname: str | None,
+        timeout: float | None,
+    ):
+        token = _tls_session.set(self._sessions.get(self._target))
+        try:
+            await self._writer.start_tls(
+                ssl_context,
+                server_hostname='',  # Bypass SNI RST
+                ssl_handshake_timeout=timeout,
+                ssl_shutdown_timeout=timeout,
+            )
+        finally:
+            _tls_session.reset(token)
+        ssl_object: ssl.SSLObject = self._writer.get_extra_info('ssl_object')
+        if ssl_object.session_reused:
+            _metrics.count('tls_resumptions')
+        else:
+            _metrics.count('tls_handshakes')
+        self._save_session()
+        peercert = self._writer.get_extra_info('peercert')
+        if server_hostname:
+            _match_hostname(peercert, self._names or [server_hostname])
+
+    def _observe_read(self):
+        if self._front and self._read_size:
+            self._front.observe_read(self._read_size, self._read_seconds)
+        self._read_seconds = 0.0
+        self._read_size = 0
 
-def _dms_json(dms: Domand, format_: Format, /) -> pydantic.JsonValue:
-    audio_src_id = (max if format_ == 'best' else min)(
+    def _save_session(self):
+        ssl_object: ssl.SSLObject | None = self._writer.get_extra_info(
+            'ssl_object',
+        )
+        if ssl_object and (session := ssl_object.session):
+            if session.has_ticket:  # Otherwise it cannot be resumed
+                self._sessions[self._target] = session
+                self._saved = True
+
+
+class _HostLimits(httpx.AsyncBaseTransport):
+    """Cap the requests in flight to each host.
+
+    Requests wait here, before the pool ties them to a connection, so a
+    waiting request can take whichever connection to its host frees up.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, limit: int):
+        self._slots: dict[str, asyncio.BoundedSemaphore] = (
+            collections.defaultdict(lambda: asyncio.BoundedSemaphore(limit))
+        )
+        self._transport = transport
+
+    @override
+    async def handle_async_request(self, request: httpx.Request):
+        slot = self._slots[request.url.host]
+        await slot.acquire()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            slot.release()
+            raise
+        assert isinstance(response.stream, httpx.AsyncByteStream)
+        response.stream = _SlotStream(response.stream, slot)
+        return response
+
+    @override
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+class _SlotStream(httpx.AsyncByteStream):
+    """Response body that frees its host slot once closed."""
+
+    def __init__(
+        self,
+        stream: httpx.AsyncByteStream,
+        slot: asyncio.BoundedSemaphore,
+    ):
+        self._slot: asyncio.BoundedSemaphore | None = slot
+        self._stream = stream
+
+    @override
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    @override
+    async def aclose(self):
+        if self._slot:
+            self._slot.release()
+            self._slot = None
+        await self._stream.aclose()
+
+
+class _TLSContext(ssl.SSLContext):
+    """Client context that resumes the session set in `_tls_session`.
+
+    asyncio has no way to pass a session to `start_tls`, but it wraps the
+    connection within the context of the call.
+    """
+
+    @override
+    def wrap_bio(
+        self,
+        incoming: ssl.MemoryBIO,
+        outgoing: ssl.MemoryBIO,
+        server_side: bool = False,
+        server_hostname: str | bytes | None = None,
+        session: ssl.SSLSession | None = None,
+    ):
+        return super().wrap_bio(
+            incoming,
+            outgoing,
+            server_side,
+            server_hostname,
+            session or _tls_session.get(),
+        )
+
+
+def _dms_audio(dms: Domand, format_: Format, /):
+    return (max if format_ == 'best' else min)(
         [a for a in dms.audios if a.isAvailable],
         key=lambda a: a.qualityLevel,
-    ).id
+    )
+
+
+def _dms_json(dms: Domand, audio: DomandItem, /) -> pydantic.JsonValue:
+    audio_src_id = audio.id
     video_src_id = min(
         [a for a in dms.videos if a.isAvailable],
         key=lambda a: a.qualityLevel,
@@ -221,49 +752,41 @@ def _dms_json(dms: Domand, format_: Format, /) -> pydantic.JsonValue:
     return {'outputs': [[video_src_id, audio_src_id]]}
 
 
+def _dump(id_: str, response: httpx.Response, /):
+    """Save the response that failed to parse for inspection."""
+    states = _main.states.get()
+    t = time.strftime('%Y%m%d%H%M%S')
+    if content_type := response.headers.get('Content-Type'):
+        mime_type = content_type.partition(';')[0].strip()
+        ext = mimetypes.guess_extension(mime_type) or ''
+    else:
+        ext = ''
+    fullname = os.path.join(states['log_dir'], f'{id_}-{t}{ext}')
+    with open(fullname, 'w', encoding='utf-8') as f:
+        f.write(response.text)
+    _logger.exception(
+        'Failed to download %s, see %s for details',
+        id_,
+        fullname,
+    )
+
+
 async def _event_hook(response: httpx.Response):
     if not response.has_redirect_location:
         response.raise_for_status()
 
 
-async def _m3u8_concat(
+async def _ffmpeg_concat(
     id_: str,
     output_file: str,
-    iv: bytes,
+    spool: Spool | None,
     header: bytes,
-    key: bytes,
-    *segments: bytes,
+    segments: AsyncGenerator[memoryview],
 ):
-    states = _main.states.get()
-    ffi = states['ffi']
-    lib = states['lib']
-
-    buf1 = bytearray(
-        288  # sizeof(struct AVAES)
-        + 16  # iv
-    )
-    buf1[288:] = iv
-    n = len(header)
-    buf2 = bytearray(sum(map(len, segments), n))
-    buf2[:n] = header
-    with (
-        ffi.from_buffer('uint8_t[]', buf1, require_writable=True) as a,
-        ffi.from_buffer('uint8_t[]', buf2, require_writable=True) as b,
-    ):
-        err = lib.av_aes_init(a, key, 128, 1)
-        assert not err
-        backup = bytes(buf1)
-        iv_ = a + 288  # pyright: ignore[reportUnknownVariableType]
-        for segment in segments:
-            i = len(segment)
-            buf2[n : n+i] = segment
-            dst = src = b + n  # pyright: ignore[reportUnknownVariableType]
-            lib.av_aes_crypt(a, dst, src, i//16, iv_, 1)
-            buf1[:] = backup
-            n += i - buf2[n+i-1]
     args = [
         'ffmpeg',
         '-hide_banner',
+        '-y',
         '-i', '-',
         '-c', 'copy',
         '-metadata', f'comment={id_}',
@@ -275,15 +798,173 @@ async def _m3u8_concat(
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
     )
-    stdout, stderr = await proc.communicate(buf2[:n])
-    if returncode := proc.returncode:
+    assert proc.stdin and proc.stdout and proc.stderr
+    stdin = proc.stdin
+    output = asyncio.gather(proc.stdout.read(), proc.stderr.read())
+    try:
+        stdin.write(header)
+        async with contextlib.aclosing(segments):
+            async for segment in segments:
+                stdin.write(segment)
+                _tee(spool, header, segment)
+                with _metrics.phase('mux'):
+                    await stdin.drain()
+        stdin.close()
+    except (BrokenPipeError, ConnectionResetError):
+        pass  # ffmpeg exited early, report its error below
+    except BaseException:
+        proc.kill()
+        output.cancel()
+        await proc.wait()
+        raise
+    with _metrics.phase('mux'):
+        stdout, stderr = await output
+        returncode = await proc.wait()
+    if returncode:
         raise subprocess.CalledProcessError(returncode, args, stdout, stderr)
 
 
-async def _m3u8_header(client: httpx.AsyncClient, url: str):
-    async with _main.states.get()['pool']:
-        response = await client.get(url)
-    return response.content
+async def _index(
+    id_: str,
+    format_: Format,
+    quality: int,
+    fullname: str,
+    duration: float,
+):
+    states = _main.states.get()
+    loop = asyncio.get_running_loop()
+    with _metrics.phase('index'):
+        sha256 = await loop.run_in_executor(
+            states['executor'],
+            _sha256,
+            fullname,
+        )
+    states['library'].add(
+        id_,
+        format_,
+        quality=quality,
+        fullname=fullname,
+        duration=duration,
+        sha256=sha256,
+    )
+
+
+def _listed(value: str | list[str], /):
+    return [value] if isinstance(value, str) else value
+
+
+async def _m3u8_concat(
+    id_: str,
+    output_file: str,
+    spool: Spool | None,
+    header: bytes,
+    segments: AsyncGenerator[memoryview],
+):
+    mux = _main.states.get()['settings'].mux
+    if mux != 'ffmpeg':
+        try:
+            writer = _mp4.Writer(output_file, header, id_, plain=mux == 'mp4')
+        except (NotImplementedError, ValueError) as e:
+            _logger.info('Muxing %s with ffmpeg: %s', id_, e)
+        else:
+            with writer:
+                async with contextlib.aclosing(segments):
+                    async for segment in segments:
+                        with _metrics.phase('mux'):
+                            writer.write(segment)
+                        _tee(spool, header, segment)
+                with _metrics.phase('mux'):
+                    writer.finish()
+            return
+    await _ffmpeg_concat(id_, output_file, spool, header, segments)
+
+
+async def _m3u8_fetch(
+    client: httpx.AsyncClient,
+    url: str,
+    latencies: list[float] | None = None,
+):
+    async with _main.states.get()['pool'](url).slot() as slot:
+        if latencies is None:
+            content = await _m3u8_get(client, url)
+        else:
+            content = await _m3u8_hedge(client, url, latencies)
+        slot.size = len(content)
+    return content
+
+
+async def _m3u8_get(client: httpx.AsyncClient, url: str):
+    """GET `url` into a buffer preallocated from its Content-Length.
+
+    Chunks land at their final offsets, so the body is copied once and
+    the buffer can then be decrypted in place.
+    """
+    async with client.stream('GET', url) as response:
+        content = bytearray(int(response.headers.get('Content-Length', 0)))
+        size = 0
+        async for chunk in response.aiter_bytes():
+            # Overwrites in place, and only grows past a short estimate
+            content[size:size+len(chunk)] = chunk
+            size += len(chunk)
+    del content[size:]
+    return content
+
+
+async def _m3u8_hedge(
+    client: httpx.AsyncClient,
+    url: str,
+    latencies: list[float],
+):
+    """GET `url`, racing a duplicate once it outlasts most of its siblings.
+
+    `latencies` holds those of the sibling segments. The duplicate gets
+    another pooled connection, since the first one is busy, and the
+    first response to succeed wins.
+    """
+    states = _main.states.get()
+    hedges = states['hedges']
+    percentile = states['settings'].hedge_percentile
+    hedges.earn()
+    start = time.perf_counter()
+    first = asyncio.create_task(_m3u8_get(client, url))
+    pending = {first}
+    try:
+        if len(latencies) >= _HEDGE_AFTER:
+            q = statistics.quantiles(latencies, n=100, method='inclusive')
+            done, _ = await asyncio.wait(pending, timeout=q[percentile - 1])
+            if not done and hedges.take():
+                _metrics.count('hedges')
+                pending.add(asyncio.create_task(_m3u8_get(client, url)))
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(
+                pending,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in done:
+                if (e := task.exception()) is None:
+                    if task is not first:
+                        _metrics.count('hedge_wins')
+                    latencies.append(time.perf_counter() - start)
+                    return task.result()
+                error = error or e
+        assert error
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def _m3u8_header(
+    client: httpx.AsyncClient,
+    track: tuple[str, str],
+    url: str,
+):
+    cache = _main.states.get()['cache']
+    if (header := await cache.get(*track, 'init')) is None:
+        header = await _m3u8_fetch(client, url)
+        await cache.put(*track, 'init', header)
+    return bytes(header)
 
 
 async def _m3u8_key(client: httpx.AsyncClient, url: str):
@@ -294,13 +975,261 @@ async def _m3u8_key(client: httpx.AsyncClient, url: str):
     return key
 
 
-async def _m3u8_segment(client: httpx.AsyncClient, url: str):
-    async with _main.states.get()['pool']:
-        response = await client.get(url)
-    segment = response.content
-    if len(segment) % 16:
-        raise ValueError('Bad segment size')
-    return segment
+async def _m3u8_segments(
+    client: httpx.AsyncClient,
+    track: tuple[str, str],
+    decrypt: Cipher,
+    access: _Access,
+    indexes: range,
+    lease: Lease,
+):
+    """Yield decrypted segments in order, fetching a bounded window ahead.
+
+    The window follows twice the current limit of the adaptive pool, and
+    shrinks while the memory budget has no room for another segment.
+    """
+    playlist = await access.playlist()
+    states = _main.states.get()
+    limiter = states['pool'](playlist.segments[0].uri)
+    latencies: list[float] | None = (
+        [] if states['settings'].hedge_budget else None
+    )
+    pending: collections.deque[asyncio.Task[memoryview]] = collections.deque()
+    try:
+        for index in indexes:
+            # Hand on what is ready rather than hold it while waiting
+            while pending and not lease.admitted:
+                yield await pending.popleft()
+            await lease.reserve(index)
+            pending.append(
+                asyncio.create_task(
+                    _m3u8_segment(
+                        client,
+                        track,
+                        index,
+                        decrypt,
+                        access,
+                        latencies,
+                        lease,
+                    ),
+                ),
+            )
+            while len(pending) >= 2 * limiter.limit:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def _m3u8_segment(
+    client: httpx.AsyncClient,
+    track: tuple[str, str],
+    index: int,
+    decrypt: Cipher,
+    access: _Access,
+    latencies: list[float] | None,
+    lease: Lease,
+):
+    states = _main.states.get()
+    cache = states['cache']
+    if (segment := await cache.get(*track, index)) is None:
+        playlist = await access.playlist()
+        start = time.perf_counter()
+        try:
+            segment = await _m3u8_fetch(
+                client,
+                playlist.segments[index].uri,
+                latencies,
+            )
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 403:
+                raise
+            playlist = await access.playlist(stale=playlist)
+            segment = await _m3u8_fetch(
+                client,
+                playlist.segments[index].uri,
+                latencies,
+            )
+        latency = time.perf_counter() - start
+        _metrics.observe('segment_latency', latency)
+        _metrics.count('segment_bytes', len(segment))
+        if len(segment) % 16:
+            raise ValueError('Bad segment size')
+        await cache.put(*track, index, segment)
+    else:
+        _metrics.count('segment_cache_hits')
+    lease.settle(index, len(segment))
+    loop = asyncio.get_running_loop()
+    with _metrics.phase('decrypt'):
+        return await loop.run_in_executor(states['executor'], decrypt, segment)
+
+
+def _m3u8_window(
+    m3u8: M3U8 | Playlist,
+    start: float,
+    end: float | None,
+    /,
+):
+    """Map a time window onto the segments overlapping it.
+
+    Return their indexes, and how far into the first one the window
+    starts, going by the EXTINF durations.
+    """
+    ends = list(itertools.accumulate(s.duration for s in m3u8.segments))
+    first = bisect.bisect_right(ends, start)
+    if first == len(ends):
+        raise ValueError('Time window outside the track')
+    stop = len(ends) if end is None else bisect.bisect_left(ends, end) + 1
+    offset = start - (ends[first-1] if first else 0)
+    return range(first, min(stop, len(ends))), offset
+
+
+@contextlib.contextmanager
+def _mapped(
+    timeout_error: type[httpcore.TimeoutException],
+    error: type[httpcore.NetworkError],
+):
+    """Raise socket errors as httpcore's, so httpx maps and retries them."""
+    try:
+        yield
+    except TimeoutError as e:
+        raise timeout_error(str(e)) from e
+    except OSError as e:  # Including SSL errors and resets
+        raise error(str(e)) from e
+
+
+def _match_hostname(peercert: Any, names: list[str], /):
+    """Accept a certificate valid for any of `names`."""
+    for name in names[:-1]:
+        try:
+            ssl_match_hostname.match_hostname(peercert, name)
+        except ssl_match_hostname.CertificateError:
+            continue
+        return
+    ssl_match_hostname.match_hostname(peercert, names[-1])
+
+
+def _sha256(fullname: str, /):
+    with open(fullname, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+async def _source(id_: str, format_: Format, /) -> Source:
+    """Fetch the metadata of a track, reusing a recently parsed page."""
+    states = _main.states.get()
+    client = states['client']
+    pages = states['pages']
+    response = None
+    access = None
+    hit = False
+    try:
+        if (root := pages.get(id_)) is None:
+            with _metrics.phase('page'):
+                response = await client.get(
+                    f'https://www.nicovideo.jp/watch/{id_}',
+                )
+            with _metrics.phase('parse_html'):
+                root = _parser.parse_html(response.content)
+            pages.put(id_, root)
+        else:
+            _metrics.count('page_cache_hits')
+            hit = True
+        if not (dms := root.media.domand):
+            raise NotImplementedError()
+        assert root.video.id == id_
+        audio = _dms_audio(dms, format_)
+        access = _Access(client, id_, dms, audio, root.client.watchTrackId)
+        m3u8 = await access.playlist()
+        with _metrics.phase('header'):
+            header, key = await asyncio.gather(
+                _m3u8_header(
+                    client,
+                    (id_, audio.id),
+                    m3u8.segment_map[0].uri,
+                ),
+                _m3u8_key(client, m3u8.keys[0].uri),
+            )
+    except Exception as e:
+        pages.discard(id_)
+        if hit and isinstance(e, httpx.HTTPStatusError):
+            return await _source(id_, format_)  # The page may have gone stale
+        if access and access.response:
+            response = access.response
+        if response and not isinstance(e, httpx.HTTPStatusError):
+            _dump(id_, response)
+        raise
+    return Source(access, audio, header, key)
+
+
+def _tee(
+    spool: Spool | None,
+    header: bytes,
+    segment: memoryview,
+    /,
+):
+    if spool:
+        if spool.empty:
+            spool.write(header)
+        spool.write(segment)
+
+
+@contextlib.contextmanager
+def _temporary(output_file: str, /):
+    """Yield a new file beside `output_file`, removed once done with.
+
+    Writers fill it and `os.replace` it over the output, so an interrupted
+    download never leaves a truncated file where a finished one belongs.
+    """
+    root, ext = os.path.splitext(output_file)
+    fd, temporary = tempfile.mkstemp(
+        f'.part{ext}',  # ffmpeg picks the container from the extension
+        f'.{os.path.basename(root)}.',
+        os.path.dirname(output_file),
+    )
+    os.close(fd)
+    os.chmod(temporary, 0o644)  # Not mkstemp's 0o600, the output keeps it
+    try:
+        yield temporary
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temporary)
+
+
+async def _trim(
+    input_file: str,
+    output_file: str,
+    /,
+    start: float = 0,
+    duration: float | None = None,
+):
+    with _temporary(output_file) as trimmed:
+        args = [
+            'ffmpeg',
+            '-hide_banner',
+            '-y',
+            '-ss', str(start),
+            '-i', input_file,
+            *([] if duration is None else ['-t', str(duration)]),
+            '-c', 'copy',
+            trimmed,
+        ]
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        stdout, stderr = await proc.communicate()
+        if returncode := proc.returncode:
+            raise subprocess.CalledProcessError(
+                returncode,
+                args,
+                stdout,
+                stderr,
+            )
+        os.replace(trimmed, output_file)
 
 
 def _user_agent():
@@ -345,4 +1274,19 @@ def _user_agent():
     return json.dumps(user_agent, separators=(' ', '/'))[1:-1].replace('"', '')
 
 
+async def _written(segments: AsyncGenerator[memoryview], lease: Lease, /):
+    """Pass `segments` on, releasing each once the next is asked for."""
+    async with contextlib.aclosing(segments):
+        async for segment in segments:
+            yield segment
+            lease.release()
+
+
+_HEDGE_AFTER = 10  # Sibling latencies needed before hedging
+_PREVIEW = 120  # Seconds of audio in the 'worst' format
+_RENEW_MARGIN = 60  # Seconds before expiry to renew access rights
+_THROUGHPUT_SAMPLE = 1 << 20  # Bytes read between throughput samples
 _logger = logging.getLogger(__package__)
+_tls_session: contextvars.ContextVar[ssl.SSLSession | None] = (
+    contextvars.ContextVar('tls_session', default=None)
+)
@@ -0,0 +1,160 @@
+__all__ = ('Endpoints', 'Front')
+
+import asyncio
+import logging
+import time
+import urllib.parse
+
+
+class Endpoints:
+    """Candidate fronts for each remapped host, ranked by how they perform.
+
+    Connects are raced happy-eyeballs style: the best ranked front goes
+    first, and the next one joins whenever an attempt fails or `stagger`
+    seconds pass without a connection. The first connection wins. A front
+    that fails to connect sits out a cooldown that doubles with every
+    consecutive failure, and is only tried again after the healthy ones.
+    """
+
+    def __init__(self, hosts: dict[str, list[str]], stagger: float = 0.25):
+        # Targets may carry a port, e.g. a local stand-in server
+        self._fronts = {
+            host: [Front(urllib.parse.urlsplit(f'//{t}')) for t in targets]
+            for host, targets in hosts.items()
+        }
+        self._stagger = stagger
+
+    def __contains__(self, host: str):
+        return host in self._fronts
+
+    async def connect(
+        self,
+        host: str,
+        port: int,
+        local_address: str | None = None,
+    ):
+        """Connect to the first front of `host` that answers."""
+        fronts = iter(self._ranked(host))
+        pending: set[
+            asyncio.Task[
+                tuple[asyncio.StreamReader, asyncio.StreamWriter, Front]
+            ]
+        ] = set()
+        error: BaseException | None = None
+        try:
+            while True:
+                front = next(fronts, None)
+                if front:
+                    pending.add(
+                        asyncio.create_task(
+                            _open(front, port, local_address),
+                        ),
+                    )
+                elif not pending:
+                    break
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=self._stagger if front else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                winners = [t.result() for t in done if not t.exception()]
+                for _, writer, _ in winners[1:]:  # Tied, keep one
+                    writer.close()
+                if winners:
+                    return winners[0]
+                for task in done:
+                    error = error or task.exception()
+            assert error
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _ranked(self, host: str):
+        now = time.monotonic()
+        return sorted(
+            self._fronts[host],
+            key=lambda front: (front.cooling(now), front.score),
+        )
+
+
+class Front:
+    """One front with its smoothed connect RTT and read throughput."""
+
+    def __init__(self, target: urllib.parse.SplitResult):
+        self.hostname = target.hostname or ''
+        self.port = target.port
+        self._failures = 0
+        self._rtt: float | None = None
+        self._throughput: float | None = None  # Bytes per second
+        self._until = float('-inf')  # End of the cooldown
+
+    @property
+    def score(self):
+        """Expected seconds to connect and read a typical segment.
+
+        A front never measured scores best, so that it gets measured.
+        """
+        if self._rtt is None:
+            return 0.0
+        if not self._throughput:
+            return self._rtt
+        return self._rtt + _SAMPLE / self._throughput
+
+    def connected(self, seconds: float):
+        self._failures = 0
+        self.observe_rtt(seconds)
+
+    def cooling(self, now: float):
+        return now < self._until
+
+    def fail(self):
+        self._failures += 1
+        cooldown = min(_COOLDOWN * 2 ** (self._failures - 1), _COOLDOWN_MAX)
+        self._until = time.monotonic() + cooldown
+        _logger.warning(
+            'Front %s failed %d time(s), cooling down for %gs',
+            self.hostname,
+            self._failures,
+            cooldown,
+        )
+
+    def lost(self, seconds: float):
+        """Lost a race after `seconds`, which only bounds its RTT below."""
+        if self._rtt is None or self._rtt < seconds:
+            self._rtt = seconds
+
+    def observe_read(self, size: int, seconds: float):
+        if size and seconds > 0:
+            self._throughput = _smooth(self._throughput, size / seconds)
+
+    def observe_rtt(self, seconds: float):
+        self._rtt = _smooth(self._rtt, seconds)
+
+
+async def _open(front: Front, port: int, local_address: str | None):
+    start = time.monotonic()
+    try:
+        reader, writer = await asyncio.open_connection(
+            front.hostname,
+            front.port or port,
+            local_addr=local_address,
+        )
+    except OSError:
+        front.fail()
+        raise
+    except asyncio.CancelledError:
+        front.lost(time.monotonic() - start)
+        raise
+    front.connected(time.monotonic() - start)
+    return reader, writer, front
+
+
+def _smooth(average: float | None, sample: float, /):
+    return sample if average is None else average + 0.2 * (sample - average)
+
+
+_COOLDOWN = 5  # Seconds out after a first failure
+_COOLDOWN_MAX = 300
+_SAMPLE = 1 << 18  # Bytes of a typical segment, to weigh RTT and throughput
+_logger = logging.getLogger(__package__)
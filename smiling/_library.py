@@ -0,0 +1,86 @@
+__all__ = ('Library',)
+
+import os
+import sqlite3
+
+
+class Library:
+    """Index of downloaded audio, stored next to it in SQLite.
+
+    Lookups go through the primary key, so they stay cheap however many
+    files the output directory holds.
+    """
+
+    def __init__(self, output_dir: str):
+        self._output_dir = output_dir
+        self._db = sqlite3.connect(
+            os.path.join(output_dir, 'library.sqlite3'),
+            autocommit=True,
+        )
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS tracks (
+                id TEXT NOT NULL,
+                format TEXT NOT NULL,
+                quality INTEGER NOT NULL,
+                filename TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                duration REAL NOT NULL,
+                sha256 TEXT NOT NULL,
+                PRIMARY KEY (id, format)
+            ) WITHOUT ROWID
+            ''',
+        )
+
+    def add(
+        self,
+        id_: str,
+        format_: str,
+        /,
+        *,
+        quality: int,
+        fullname: str,
+        duration: float,
+        sha256: str,
+    ):
+        self._db.execute(
+            'INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (
+                id_,
+                format_,
+                quality,
+                os.path.relpath(fullname, self._output_dir),
+                os.path.getsize(fullname),
+                duration,
+                sha256,
+            ),
+        )
+
+    def close(self):
+        self._db.close()
+
+    def get(self, id_: str, format_: str, /):
+        """Return the file, quality and duration of an intact entry."""
+        row: tuple[int, str, int, float] | None = self._db.execute(
+            '''
+            SELECT quality, filename, size, duration FROM tracks
+            WHERE id = ? AND format = ?
+            ''',
+            (id_, format_),
+        ).fetchone()
+        if row is None:
+            return None
+        quality, filename, size, duration = row
+        fullname = os.path.join(self._output_dir, filename)
+        try:
+            intact = os.path.getsize(fullname) == size
+        except OSError:
+            intact = False
+        if not intact:
+            self._db.execute(
+                'DELETE FROM tracks WHERE id = ? AND format = ?',
+                (id_, format_),
+            )
+            return None
+        return fullname, quality, duration
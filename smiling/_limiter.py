@@ -0,0 +1,246 @@
+__all__ = ('Budget', 'Lease', 'Limiter', 'Memory', 'Pool')
+
+import asyncio
+import collections
+import contextlib
+import time
+
+import httpx2 as httpx
+
+
+class Budget:
+    """Token bucket for extra requests, filled by ordinary ones.
+
+    Each ordinary request earns `ratio` of a token, so at most about that
+    fraction of requests are duplicated, with bursts of up to `burst`.
+    """
+
+    def __init__(self, ratio: float, burst: float = 10):
+        self._burst = burst
+        self._ratio = ratio
+        self._tokens = 0.0
+
+    def earn(self):
+        self._tokens = min(self._burst, self._tokens + self._ratio)
+
+    def take(self):
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class Lease:
+    """The segments of one track held in a `Memory`, oldest first."""
+
+    def __init__(self, memory: Memory):
+        self._memory = memory
+        self._sizes: dict[int, int] = {}
+
+    @property
+    def admitted(self):
+        """Whether `reserve` would return without waiting."""
+        return self._memory.admits(self)
+
+    @property
+    def held(self):
+        return sum(self._sizes.values())
+
+    def close(self):
+        """Release whatever is still held, e.g. when the track fails."""
+        self._memory.free(self.held)
+        self._sizes.clear()
+
+    def release(self):
+        """Release the oldest segment, once it has been written."""
+        if self._sizes:
+            self._memory.free(self._sizes.pop(next(iter(self._sizes))))
+
+    async def reserve(self, index: int):
+        """Wait for room for segment `index`, before fetching it."""
+        size = await self._memory.reserve(self)
+        self._sizes[index] = size
+
+    def settle(self, index: int, size: int):
+        """Correct the reservation of segment `index` to its real size."""
+        if (reserved := self._sizes.get(index)) is not None:
+            self._sizes[index] = size
+            self._memory.settle(reserved, size)
+
+
+class Limiter:
+    """Concurrency limit tuned by additive increase/multiplicative decrease.
+
+    Every successful request raises the limit by about one per window.
+    Throttling responses, timeouts and transport errors halve it, and a
+    rising cost per byte over the best one seen shrinks it before the CDN
+    starts refusing. Only requests admitted after the last decrease can
+    trigger another one.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int):
+        self._base = float('inf')  # Lowest seconds per byte seen
+        self._cost: float | None = None  # Smoothed seconds per byte
+        self._decreased = float('-inf')
+        self._inflight = 0
+        self._limit = float(min(max(initial, minimum), maximum))
+        self._maximum = maximum
+        self._minimum = minimum
+        self._waiters: collections.deque[asyncio.Future[None]] = (
+            collections.deque()
+        )
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        await self._acquire()
+        slot = _Slot()
+        start = time.monotonic()
+        try:
+            yield slot
+        except BaseException as e:
+            if _congested(e):
+                self._decrease(0.5, start)
+            raise
+        else:
+            self._observe(start, slot.size)
+        finally:
+            self._inflight -= 1
+            self._wake()
+
+    async def _acquire(self):
+        while self._inflight >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self._wake()  # Pass the wake-up on
+                raise
+            finally:
+                self._waiters.remove(waiter)
+        self._inflight += 1
+
+    def _decrease(self, factor: float, start: float):
+        if start < self._decreased:
+            return
+        self._decreased = time.monotonic()
+        self._limit = max(self._minimum, self._limit * factor)
+
+    def _observe(self, start: float, size: int):
+        if size:
+            cost = (time.monotonic() - start) / size
+            self._base = min(self._base * 1.01, cost)  # Slowly forget
+            if self._cost is None:
+                self._cost = cost
+            else:
+                self._cost += 0.2 * (cost - self._cost)
+            if self._cost > 2 * self._base:
+                self._decrease(0.8, start)
+                return
+        self._limit = min(self._maximum, self._limit + 1 / self._limit)
+
+    def _wake(self):
+        free = self.limit - self._inflight
+        for waiter in self._waiters:
+            if free <= 0:
+                break
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+
+class Memory:
+    """Byte budget for the segments held between their fetch and write.
+
+    Fetches reserve the largest segment size seen before they start and
+    settle it once the response is in. A track holding nothing is always
+    admitted, so the track being written never waits on tracks that are
+    not, and the budget is overrun by at most one segment per track.
+    """
+
+    def __init__(self, capacity: int):
+        self._capacity = capacity
+        self._estimate = _SEGMENT
+        self._seen = False
+        self._used = 0
+        self._waiters: list[tuple[asyncio.Future[None], Lease]] = []
+
+    def admits(self, lease: Lease):
+        return (
+            not lease.held or self._used + self._estimate <= self._capacity
+        )
+
+    def free(self, size: int):
+        self._used -= size
+        self._wake()
+
+    def lease(self):
+        return Lease(self)
+
+    async def reserve(self, lease: Lease):
+        """Wait until `lease` is admitted, and return the bytes reserved."""
+        while not self.admits(lease):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append((waiter, lease))
+            try:
+                await waiter
+            finally:
+                self._waiters.remove((waiter, lease))
+        self._used += self._estimate
+        return self._estimate
+
+    def settle(self, reserved: int, size: int):
+        self._used += size - reserved
+        if size > self._estimate or not self._seen:
+            self._estimate = size
+            self._seen = True
+        self._wake()
+
+    def _wake(self):
+        for waiter, lease in self._waiters:
+            if not waiter.done() and self.admits(lease):
+                waiter.set_result(None)
+
+
+class Pool:
+    """Adaptive limiters shared globally or per host."""
+
+    def __init__(
+        self,
+        initial: int,
+        minimum: int,
+        maximum: int,
+        per_host: bool,
+    ):
+        self._limiters: dict[str, Limiter] = collections.defaultdict(
+            lambda: Limiter(initial, minimum, maximum),
+        )
+        self._per_host = per_host
+
+    def __call__(self, url: str):
+        return self._limiters[httpx.URL(url).host if self._per_host else '']
+
+
+class _Slot:
+    __slots__ = ('size',)
+
+    def __init__(self):
+        self.size = 0
+
+
+def _congested(e: BaseException, /):
+    match e:
+        case httpx.HTTPStatusError(response=httpx.Response(status_code=code)):
+            return code == 429 or code >= 500
+        case httpx.TransportError():  # Including timeouts
+            return True
+        case _:
+            return False
+
+
+_SEGMENT = 1 << 20  # Bytes reserved per segment before any is seen
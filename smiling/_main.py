@@ -1,34 +1,54 @@
-__all__ = ('cli_cmd', 'main', 'states')
+__all__ = ('cli_cmd', 'main', 'play', 'states')
 
 import asyncio
+import concurrent.futures
 import contextlib
 import contextvars
-import glob
 import logging.handlers
 import os
 import pdb
 import subprocess
+import sys
 import traceback
-from typing import cast
 from typing import override
 
-import cffi
-import rich.logging
-
+from . import _batch
+from . import _crypto
 from . import _downloader
 from . import _parser
+from . import _server
+from ._cache import SegmentCache
+from ._cache import TTLCache
+from ._library import Library
+from ._limiter import Budget
+from ._limiter import Memory
+from ._limiter import Pool
+from ._metrics import Metrics
 from ._types import Format
-from ._types import Lib
 from ._types import Settings
 from ._types import States
 
 states: contextvars.ContextVar[States] = contextvars.ContextVar('states')
 
 
-def cli_cmd(audio: str, format_: Format, /):
-    id_ = _parser.parse_id(audio)
+def cli_cmd(
+    audio: list[str],
+    format_: Format,
+    progressive: bool,
+    tracks: int | None,
+    start: float | None,
+    end: float | None,
+    /,
+):
+    ids = _parser.parse_ids('\n'.join(map(_read, audio)))
+    if len(ids) > 1:
+        results = asyncio.run(_batch_cmd(ids, format_, tracks, start, end))
+        failed = [k for k, v in results.items() if isinstance(v, Exception)]
+        if failed:
+            sys.exit(f'Failed to download {len(failed)}/{len(ids)}: {failed}')
+        return
     try:
-        asyncio.run(_cli_cmd(id_, format_))
+        asyncio.run(_cli_cmd(ids[0], format_, progressive, start, end))
     except:
         traceback.print_exc()
         pdb.post_mortem()
@@ -38,20 +58,67 @@ def main():
     asyncio.run(_main())
 
 
-async def _cli_cmd(id_: str, format_: Format, /):
+async def _batch_cmd(
+    ids: list[str],
+    format_: Format,
+    tracks: int | None,
+    start: float | None,
+    end: float | None,
+    /,
+):
     async with _states(logging.DEBUG) as s:
         states.set(s)
-        fullname = await _downloader.download(id_, format_)
-        await _play(id_, fullname)
+        return await _batch.run(
+            ids,
+            format_,
+            tracks or s['settings'].workers,
+            start=start,
+            end=end,
+        )
+
+
+async def _cli_cmd(
+    id_: str,
+    format_: Format,
+    progressive: bool,
+    start: float | None,
+    end: float | None,
+    /,
+):
+    async with _states(logging.DEBUG) as s:
+        states.set(s)
+        if progressive:
+            with _downloader.Spool() as spool:
+                async with asyncio.TaskGroup() as tg:
+                    task = tg.create_task(
+                        _downloader.download(
+                            id_,
+                            format_,
+                            spool=spool,
+                            start=start,
+                            end=end,
+                        ),
+                    )
+                    if await _play_spool(id_, spool):
+                        return
+                fullname = task.result()
+        else:
+            fullname = await _downloader.download(
+                id_,
+                format_,
+                start=start,
+                end=end,
+            )
+        await play(id_, fullname)
 
 
 async def _main():
     async with _states(logging.INFO) as s:
         states.set(s)
-        raise NotImplementedError()
+        await _server.serve()
 
 
-async def _play(id_: str, fullname: str, /):
+async def play(id_: str, fullname: str, /):
     proc = await asyncio.create_subprocess_exec(
         'ffplay',
         '-hide_banner',
@@ -64,6 +131,37 @@ async def _play(id_: str, fullname: str, /):
     await proc.wait()
 
 
+async def _play_spool(id_: str, spool: _downloader.Spool, /):
+    """Play the track while it downloads, unless nothing is streamed."""
+    await spool.ready.wait()
+    if spool.empty:
+        return False
+    proc = await asyncio.create_subprocess_exec(
+        'ffplay',
+        '-hide_banner',
+        '-window_title', id_,
+        '-',
+        stdin=subprocess.PIPE,
+    )
+    assert proc.stdin
+    try:
+        await spool.follow(proc.stdin)
+        proc.stdin.close()
+    except (BrokenPipeError, ConnectionResetError):
+        pass  # The player was closed early
+    await proc.wait()
+    return True
+
+
+def _read(item: str, /):
+    if item == '-':
+        return sys.stdin.read()
+    if item.startswith('@'):
+        with open(item[1:], encoding='utf-8') as f:
+            return f.read()
+    return item
+
+
 class _RotatingFileHandler(logging.handlers.RotatingFileHandler):
     @override
     def _open(self):
@@ -79,7 +177,12 @@ class _RotatingFileHandler(logging.handlers.RotatingFileHandler):
 
 @contextlib.asynccontextmanager
 async def _states(level: int):
-    log_dir = os.path.abspath(os.path.join(__file__, '../../log'))
+    settings = Settings()
+    data_dir = os.path.abspath(
+        settings.data_dir or os.path.join(__file__, '../..'),
+    )
+
+    log_dir = os.path.join(data_dir, 'log')
     os.makedirs(log_dir, exist_ok=True)
     if level >= logging.INFO:
         handler = _RotatingFileHandler(
@@ -96,53 +199,68 @@ async def _states(level: int):
             ),
         )
     else:
+        import rich.logging
+
         handler = rich.logging.RichHandler()
     logger = logging.getLogger(__package__)
     logger.addHandler(handler)
     logger.setLevel(level)
 
-    output_dir = os.path.abspath(os.path.join(__file__, '../../output'))
+    output_dir = os.path.join(data_dir, 'output')
     os.makedirs(output_dir, exist_ok=True)
 
-    settings = Settings()
-    event_hooks, network_backend = _downloader.prepare(
-        settings.hosts,
-        settings.sni_hostname,
-    )
+    cache_dir = os.path.join(data_dir, 'cache')
+    os.makedirs(cache_dir, exist_ok=True)
 
-    [libpath] = glob.iglob(
-        os.path.join(os.environ['CONDA_PREFIX'], r'Library\bin\avutil-*.dll'),
-    )
-    ffi = cffi.FFI()
-    ffi.cdef(
-        '''
-        int av_aes_init(
-            uint8_t *a,
-            const uint8_t *key,
-            int key_bits,
-            int decrypt
-        );
-
-        void av_aes_crypt(
-            uint8_t *a,
-            uint8_t *dst,
-            const uint8_t *src,
-            int count,
-            uint8_t *iv,
-            int decrypt
-        );
-        ''',
-    )
-    lib = ffi.dlopen(libpath)
-    try:
-        yield States(
-            event_hooks=event_hooks,
-            ffi=ffi,
-            lib=cast(Lib, lib),
-            log_dir=log_dir,
-            network_backend=network_backend,
-            output_dir=output_dir,
-            pool=asyncio.BoundedSemaphore(settings.parallel),
-        )
-    finally:
-        ffi.dlclose(lib)
+    client = _downloader.prepare(settings)
+
+    with (
+        contextlib.closing(_crypto.load(settings.aes)) as aes,
+        concurrent.futures.ThreadPoolExecutor(
+            settings.decrypt_threads,
+            thread_name_prefix='decrypt',
+        ) as executor,
+        contextlib.closing(Library(output_dir)) as library,
+    ):
+        logger.debug('Decrypting with %s', aes.name)
+        async with client:
+            # Handshake with the hosts while the first page loads
+            prewarming = asyncio.create_task(
+                _downloader.prewarm(client, settings),
+            )
+            try:
+                cache = SegmentCache(cache_dir, settings.cache_size, executor)
+                # Segments all come from one host, past its cap they queue
+                parallel_max = min(
+                    settings.parallel_max,
+                    settings.max_connections_per_host,
+                )
+                yield States(
+                    aes=aes,
+                    cache=cache,
+                    client=client,
+                    executor=executor,
+                    hedges=Budget(settings.hedge_budget),
+                    library=library,
+                    log_dir=log_dir,
+                    memory=Memory(settings.buffer_size),
+                    metrics=Metrics(log_dir),
+                    output_dir=output_dir,
+                    pages=TTLCache(
+                        settings.metadata_size,
+                        settings.metadata_ttl,
+                    ),
+                    pool=Pool(
+                        settings.parallel,
+                        min(settings.parallel_min, parallel_max),
+                        parallel_max,
+                        settings.parallel_per_host,
+                    ),
+                    settings=settings,
+                    sources=TTLCache(
+                        settings.metadata_size,
+                        settings.metadata_ttl,
+                    ),
+                )
+            finally:
+                prewarming.cancel()
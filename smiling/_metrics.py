@@ -0,0 +1,154 @@
+__all__ = (
+    'Metrics',
+    'Trace',
+    'count',
+    'observe',
+    'phase',
+    'trace',
+    'tracing',
+)
+
+import bisect
+import collections
+import contextlib
+import contextvars
+import json
+import os
+import statistics
+import time
+
+assert __package__
+
+
+class Trace:
+    """Phase timings and counters of one download."""
+
+    def __init__(self, id_: str, format_: str):
+        self.counters: collections.Counter[str] = collections.Counter()
+        self.format = format_
+        self.id = id_
+        self.phases: dict[str, float] = collections.defaultdict(float)
+        self.samples: dict[str, list[float]] = collections.defaultdict(list)
+        self.start = time.time()
+        self.status = 'running'
+        self._start = time.perf_counter()
+
+    def finish(self, status: str):
+        self.status = status
+        self.phases['total'] = time.perf_counter() - self._start
+
+    def to_json(self):
+        samples: dict[str, dict[str, float]] = {}
+        for name, values in self.samples.items():
+            if len(values) > 1:
+                q = statistics.quantiles(values, n=100, method='inclusive')
+                p50, p90, p99 = q[49], q[89], q[98]
+            else:
+                p50 = p90 = p99 = values[0]
+            samples[name] = {
+                'count': len(values),
+                'p50': p50,
+                'p90': p90,
+                'p99': p99,
+                'max': max(values),
+            }
+        return json.dumps({
+            'id': self.id,
+            'format': self.format,
+            'status': self.status,
+            'start': self.start,
+            'phases': self.phases,
+            'counters': self.counters,
+            'samples': samples,
+        })
+
+
+class Metrics:
+    """Process-wide totals of finished traces.
+
+    Every trace is appended to `metrics.jsonl` in the log directory, and
+    the totals are rendered in the Prometheus text format.
+    """
+
+    def __init__(self, log_dir: str):
+        self._counters: collections.Counter[str] = collections.Counter()
+        self._fullname = os.path.join(log_dir, 'metrics.jsonl')
+        self._histograms: dict[str, list[int]] = collections.defaultdict(
+            lambda: [0] * (len(_BUCKETS) + 1),
+        )
+        self._jobs: collections.Counter[str] = collections.Counter()
+        self._phases: dict[str, float] = collections.defaultdict(float)
+        self._sums: dict[str, float] = collections.defaultdict(float)
+
+    def add(self, trace: Trace, /):
+        self._counters.update(trace.counters)
+        self._jobs[trace.status] += 1
+        for name, seconds in trace.phases.items():
+            self._phases[name] += seconds
+        for name, values in trace.samples.items():
+            buckets = self._histograms[name]
+            for value in values:
+                buckets[bisect.bisect_left(_BUCKETS, value)] += 1
+            self._sums[name] += sum(values)
+        with open(self._fullname, 'a', encoding='utf-8') as f:
+            f.write(trace.to_json() + '\n')
+
+    def render(self):
+        lines = [f'# TYPE {_PREFIX}_downloads_total counter']
+        for status, n in sorted(self._jobs.items()):
+            lines.append(f'{_PREFIX}_downloads_total{{status="{status}"}} {n}')
+        lines.append(f'# TYPE {_PREFIX}_phase_seconds_total counter')
+        for name, seconds in sorted(self._phases.items()):
+            lines.append(
+                f'{_PREFIX}_phase_seconds_total{{phase="{name}"}} {seconds}',
+            )
+        for name, n in sorted(self._counters.items()):
+            lines.append(f'# TYPE {_PREFIX}_{name}_total counter')
+            lines.append(f'{_PREFIX}_{name}_total {n}')
+        for name, buckets in sorted(self._histograms.items()):
+            metric = f'{_PREFIX}_{name}_seconds'
+            lines.append(f'# TYPE {metric} histogram')
+            total = 0
+            for le, n in zip([*map(str, _BUCKETS), '+Inf'], buckets):
+                total += n
+                lines.append(f'{metric}_bucket{{le="{le}"}} {total}')
+            lines.append(f'{metric}_sum {self._sums[name]}')
+            lines.append(f'{metric}_count {total}')
+        return '\n'.join(lines) + '\n'
+
+
+def count(name: str, n: int = 1, /):
+    if t := trace.get(None):
+        t.counters[name] += n
+
+
+def observe(name: str, seconds: float, /):
+    if t := trace.get(None):
+        t.samples[name].append(seconds)
+
+
+@contextlib.contextmanager
+def phase(name: str, /):
+    """Add the time spent in the block to a phase of the current trace."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if t := trace.get(None):
+            t.phases[name] += time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def tracing(t: Trace, /):
+    """Make `t` the current trace inside the block."""
+    token = trace.set(t)
+    try:
+        yield t
+    finally:
+        trace.reset(token)
+
+
+trace: contextvars.ContextVar[Trace] = contextvars.ContextVar('trace')
+
+_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+_PREFIX = __package__
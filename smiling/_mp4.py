@@ -0,0 +1,365 @@
+__all__ = ('Writer',)
+
+import array
+from collections.abc import Callable
+from collections.abc import Iterator
+import logging
+import struct
+
+
+class Writer:
+    """Write an fMP4 init segment and its fragments as one MP4 file.
+
+    Boxes are written as they arrive, with a comment tag in the movie box.
+    With `plain`, the sample tables are collected from the fragments and
+    a new movie box is appended on `finish`, while the fragment headers
+    are blanked into `free` boxes, so the file becomes a plain MP4 without
+    another copy of the media data.
+
+    Raises `NotImplementedError` or `ValueError` for an init segment that
+    needs a real muxer.
+    """
+
+    def __init__(
+        self,
+        output_file: str,
+        header: bytes,
+        comment: str,
+        /,
+        *,
+        plain: bool,
+    ):
+        try:
+            ftyp, moov = _init(header)
+            self._trex = _trex(moov)
+        except struct.error as e:
+            raise ValueError('Truncated init segment') from e
+        self._moov = moov
+        self._plain = plain
+        self._chunks: list[tuple[int, int]] = []  # (Offset, sample count)
+        self._durations: list[list[int]] = []  # [[Sample count, delta]]
+        self._free: list[int] = []  # Offsets of boxes to blank
+        self._sizes = array.array('I')
+        self._udta = _udta(comment)
+        self._file = open(output_file, 'wb')
+        self._file.write(ftyp)
+        self._free.append(self._file.tell())
+        self._file.write(_container(moov, {b'udta': _drop}, self._udta))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info: object):
+        self._file.close()
+
+    def finish(self):
+        f = self._file
+        if self._plain:
+            for offset in self._free:
+                f.seek(offset + 4)
+                f.write(b'free')
+            f.seek(0, 2)
+            f.write(self._plain_moov())
+        f.close()
+
+    def write(self, segment: bytes | bytearray | memoryview, /):
+        f = self._file
+        start = f.tell()
+        f.write(segment)
+        if not self._plain:
+            return
+        try:
+            self._index(segment, start)
+        except (NotImplementedError, ValueError, struct.error) as e:
+            self._plain = False
+            _logger.info('Keeping %s fragmented: %s', f.name, e)
+
+    def _index(self, segment: bytes | bytearray | memoryview, start: int):
+        end = start + len(segment)
+        for type_, box, payload, box_end in _boxes(segment):
+            if type_ == b'mdat':
+                continue
+            self._free.append(start + box)
+            if type_ == b'moof':
+                self._moof(
+                    segment[box:box_end],
+                    start + box,
+                    end,
+                    payload - box,
+                )
+
+    def _moof(
+        self,
+        moof: bytes | bytearray | memoryview,
+        offset: int,
+        end: int,
+        at: int,
+    ):
+        trafs = [b for b in _boxes(moof, at) if b[0] == b'traf']
+        if len(trafs) != 1:
+            raise NotImplementedError('Not one track fragment')
+        _, _, payload, traf_end = trafs[0]
+        _, default_duration, default_size = self._trex
+        chunks: list[tuple[int, int]] = []
+        durations: list[int] = []
+        sizes: list[int] = []
+        for type_, _, p, _ in _boxes(moof, payload, traf_end):
+            flags = int.from_bytes(moof[p+1:p+4])
+            if type_ == b'tfhd':
+                if flags & 0x1:
+                    raise NotImplementedError('Absolute base data offset')
+                p += 8
+                if flags & 0x2:
+                    if struct.unpack_from('>I', moof, p)[0] != 1:
+                        raise NotImplementedError('Sample description')
+                    p += 4
+                if flags & 0x8:
+                    default_duration, = struct.unpack_from('>I', moof, p)
+                    p += 4
+                if flags & 0x10:
+                    default_size, = struct.unpack_from('>I', moof, p)
+            elif type_ == b'trun':
+                if not flags & 0x1:
+                    raise NotImplementedError('Implicit data offset')
+                count, data_offset = struct.unpack_from('>Ii', moof, p + 4)
+                p += 12 + (4 if flags & 0x4 else 0)
+                fields = [
+                    bit for bit in (0x100, 0x200, 0x400, 0x800) if flags & bit
+                ]
+                values = struct.unpack_from(
+                    f'>{len(fields) * count}I',
+                    moof,
+                    p,
+                )
+                columns = {
+                    bit: values[i::len(fields)] for i, bit in enumerate(fields)
+                }
+                if any(columns.get(0x800, ())):
+                    raise NotImplementedError('Composition offsets')
+                run_durations = columns.get(0x100, [default_duration] * count)
+                run_sizes = columns.get(0x200, [default_size] * count)
+                if not all(run_sizes) or not all(run_durations):
+                    raise NotImplementedError('Missing sample defaults')
+                chunk = offset + data_offset
+                if chunk < offset or chunk + sum(run_sizes) > end:
+                    raise ValueError('Samples outside the fragment')
+                chunks.append((chunk, count))
+                durations.extend(run_durations)
+                sizes.extend(run_sizes)
+        # Commit only complete fragments
+        self._chunks.extend(chunks)
+        for delta in durations:
+            if self._durations and self._durations[-1][1] == delta:
+                self._durations[-1][0] += 1
+            else:
+                self._durations.append([1, delta])
+        self._sizes.extend(sizes)
+
+    def _plain_moov(self):
+        media_duration = sum(n * delta for n, delta in self._durations)
+        movie_timescale = _timescale(_child(self._moov, b'mvhd'))
+        media_timescale = _timescale(
+            _child(_child(_child(self._moov, b'trak'), b'mdia'), b'mdhd'),
+        )
+        duration = media_duration * movie_timescale // media_timescale
+
+        def elst(box: bytes):
+            return _edit_list(box, duration, movie_timescale, media_timescale)
+
+        def trak(box: bytes):
+            return _container(box, {
+                b'tkhd': lambda b: _with_duration(b, duration),
+                b'edts': lambda b: _container(b, {b'elst': elst}),
+                b'mdia': mdia,
+            })
+
+        def mdia(box: bytes):
+            return _container(box, {
+                b'mdhd': lambda b: _with_duration(b, media_duration),
+                b'minf': lambda b: _container(b, {b'stbl': stbl}),
+            })
+
+        def stbl(box: bytes):
+            return _container(
+                box,
+                dict.fromkeys(
+                    (b'co64', b'ctts', b'stco', b'stsc', b'stss', b'stsz',
+                     b'stts'),
+                    _drop,
+                ),
+                *self._sample_tables(),
+            )
+
+        return _container(self._moov, {
+            b'mvex': _drop,
+            b'mvhd': lambda b: _with_duration(b, duration),
+            b'trak': trak,
+            b'udta': _drop,
+        }, self._udta)
+
+    def _sample_tables(self):
+        stts = _full_box(
+            b'stts',
+            struct.pack('>I', len(self._durations)),
+            *(struct.pack('>II', n, delta) for n, delta in self._durations),
+        )
+        runs: list[tuple[int, int]] = []  # (First chunk, samples per chunk)
+        for i, (_, count) in enumerate(self._chunks, 1):
+            if not runs or runs[-1][1] != count:
+                runs.append((i, count))
+        stsc = _full_box(
+            b'stsc',
+            struct.pack('>I', len(runs)),
+            *(struct.pack('>III', first, count, 1) for first, count in runs),
+        )
+        stsz = _full_box(
+            b'stsz',
+            struct.pack(f'>II{len(self._sizes)}I', 0, len(self._sizes),
+                        *self._sizes),
+        )
+        offsets = [offset for offset, _ in self._chunks]
+        if offsets and offsets[-1] > 0xffffffff:
+            fmt, type_ = 'Q', b'co64'
+        else:
+            fmt, type_ = 'I', b'stco'
+        stco = _full_box(
+            type_,
+            struct.pack(f'>I{len(offsets)}{fmt}', len(offsets), *offsets),
+        )
+        return stts, stsc, stsz, stco
+
+
+def _box(type_: bytes, /, *payload: bytes | bytearray):
+    size = 8 + sum(map(len, payload))
+    return b''.join([struct.pack('>I4s', size, type_), *payload])
+
+
+def _boxes(
+    data: bytes | bytearray | memoryview,
+    start: int = 0,
+    end: int | None = None,
+    /,
+) -> Iterator[tuple[bytes, int, int, int]]:
+    """Yield the type, start, payload start and end of each box."""
+    if end is None:
+        end = len(data)
+    while start < end:
+        size, type_ = struct.unpack_from('>I4s', data, start)
+        payload = start + 8
+        if size == 1:
+            size, = struct.unpack_from('>Q', data, payload)
+            payload += 8
+        elif size == 0:
+            size = end - start
+        if size < payload - start or start + size > end:
+            raise ValueError(f'Bad {type_!r} box size')
+        yield type_, start, payload, start + size
+        start += size
+
+
+def _child(box: bytes, type_: bytes, /):
+    [(_, _, payload, end)] = _boxes(box)
+    for child_type, start, _, child_end in _boxes(box, payload, end):
+        if child_type == type_:
+            return box[start:child_end]
+    raise NotImplementedError(f'No {type_!r} box')
+
+
+def _container(
+    box: bytes,
+    edits: dict[bytes, Callable[[bytes], bytes | None]],
+    /,
+    *extra: bytes,
+):
+    """Rebuild a container box, passing its children through `edits`."""
+    [(type_, _, payload, end)] = _boxes(box)
+    children: list[bytes] = []
+    for child_type, start, _, child_end in _boxes(box, payload, end):
+        child = box[start:child_end]
+        if edit := edits.get(child_type):
+            child = edit(child)
+        if child is not None:
+            children.append(child)
+    return _box(type_, *children, *extra)
+
+
+def _drop(_box: bytes, /):
+    return None
+
+
+def _edit_list(
+    elst: bytes,
+    duration: int,
+    movie_timescale: int,
+    media_timescale: int,
+):
+    """Fill in edit durations left open by the fragmented init segment."""
+    out = bytearray(elst)
+    version = out[8]
+    count, = struct.unpack_from('>I', out, 12)
+    fmt = '>Qq' if version else '>Ii'
+    p = 16
+    for _ in range(count):
+        segment_duration, media_time = struct.unpack_from(fmt, out, p)
+        if not segment_duration and media_time >= 0:
+            skip = media_time * movie_timescale // media_timescale
+            struct.pack_into(fmt, out, p, max(0, duration - skip), media_time)
+        p += struct.calcsize(fmt) + 4  # Media rate
+    return bytes(out)
+
+
+def _full_box(type_: bytes, /, *payload: bytes):
+    return _box(type_, b'\0\0\0\0', *payload)
+
+
+def _init(header: bytes, /):
+    ftyp = moov = None
+    for type_, start, _, end in _boxes(header):
+        if type_ == b'ftyp':
+            ftyp = header[start:end]
+        elif type_ == b'moov':
+            moov = header[start:end]
+    if not ftyp or not moov:
+        raise NotImplementedError('No ftyp or moov box')
+    [(_, _, payload, end)] = _boxes(moov)
+    traks = [b for b in _boxes(moov, payload, end) if b[0] == b'trak']
+    if len(traks) != 1:
+        raise NotImplementedError('Not one track')
+    return ftyp, moov
+
+
+def _timescale(box: bytes, /):
+    return struct.unpack_from('>I', box, 28 if box[8] else 20)[0]
+
+
+def _trex(moov: bytes, /):
+    """Return the track ID and default sample duration and size."""
+    trex = _child(_child(moov, b'mvex'), b'trex')
+    track_id, _, duration, size = struct.unpack_from('>4I', trex, 12)
+    return track_id, duration, size
+
+
+def _udta(comment: str, /):
+    data = _box(b'data', struct.pack('>II', 1, 0), comment.encode())
+    hdlr = _full_box(b'hdlr', b'\0\0\0\0mdirappl', bytes(9))
+    ilst = _box(b'ilst', _box(b'\xa9cmt', data))
+    return _box(b'udta', _full_box(b'meta', hdlr, ilst))
+
+
+def _with_duration(box: bytes, duration: int, /):
+    """Set the duration field of an mvhd, tkhd or mdhd box."""
+    out = bytearray(box)
+    v0, v1 = _DURATION[box[4:8]]
+    if out[8]:
+        struct.pack_into('>Q', out, v1, duration)
+    else:
+        struct.pack_into('>I', out, v0, min(duration, 0xffffffff))
+    return bytes(out)
+
+
+_DURATION = {  # Offsets by version
+    b'mdhd': (24, 32),
+    b'mvhd': (24, 32),
+    b'tkhd': (28, 36),
+}
+_logger = logging.getLogger(__package__)
@@ -1,30 +1,29 @@
 __all__ = [
     'parse_html',
     'parse_id',
+    'parse_ids',
     'parse_m3u8',
     'pattern',
 ]
 
+import html
 import re
 
-import bs4
-import m3u8
-
 from ._types import Content
 from ._types import M3U8
+from ._types import Playlist
+from ._types import PlaylistKey
+from ._types import PlaylistSegment
+from ._types import PlaylistURI
 
 pattern = re.compile(r'\b((?:sm|nm|so|ss)\d+)\b')
 
 
-def parse_html(markup: str):
-    match bs4.BeautifulSoup(markup, 'html.parser').find(
-        name='meta',
-        attrs={'name': 'server-response', 'content': True},
-    ):
-        case bs4.Tag(attrs={'content': str(content)}):
-            return Content.model_validate_json(content).data.response
-        case _:
-            raise LookupError()
+def parse_html(markup: bytes):
+    content = _server_response(markup)
+    if content is None:
+        content = _server_response_bs4(markup)
+    return Content.model_validate_json(content).data.response
 
 
 def parse_id(input_: str):
@@ -37,6 +36,109 @@ def parse_id(input_: str):
             raise ValueError(f'Multiple video IDs found: {all_}')
 
 
-def parse_m3u8(content: str):
-    obj = m3u8.loads(content)
-    return M3U8.model_validate(obj.data)
+def parse_ids(input_: str):
+    if ids := list(dict.fromkeys(pattern.findall(input_))):
+        return ids
+    raise ValueError(f'No video ID found in {input_!r}')
+
+
+def parse_m3u8(content: str, /, *, strict: bool = False) -> M3U8 | Playlist:
+    if strict:
+        import m3u8
+
+        obj = m3u8.loads(content)
+        return M3U8.model_validate(obj.data)
+    return _parse_playlist(content)
+
+
+def _parse_playlist(content: str):
+    """Read only the tags used by Domand playlists."""
+    keys: list[PlaylistKey] = []
+    media: list[PlaylistURI] = []
+    segment_map: list[PlaylistURI] = []
+    segments: list[PlaylistSegment] = []
+    targetduration = None
+    duration = None
+    for line in content.splitlines():
+        if not (line := line.strip()):
+            continue
+        if not line.startswith('#'):
+            if duration is not None:
+                segments.append(PlaylistSegment(duration, line))
+                duration = None
+            continue
+        tag, _, value = line.partition(':')
+        match tag:
+            case '#EXTINF':
+                duration = float(value.partition(',')[0])
+            case '#EXT-X-KEY':
+                attrs = _m3u8_attrs(value)
+                if attrs['METHOD'] != 'AES-128':
+                    raise ValueError(f'Unsupported key method: {line}')
+                keys.append(PlaylistKey(int(attrs['IV'], 16), attrs['URI']))
+            case '#EXT-X-MAP':
+                segment_map.append(PlaylistURI(_m3u8_attrs(value)['URI']))
+            case '#EXT-X-MEDIA':
+                attrs = _m3u8_attrs(value)
+                if attrs['TYPE'] == 'AUDIO':
+                    media.append(PlaylistURI(attrs['URI']))
+            case '#EXT-X-TARGETDURATION':
+                targetduration = int(value)
+            case _:
+                pass
+    return Playlist(keys, media, segment_map, segments, targetduration)
+
+
+def _m3u8_attrs(value: str):
+    return {k: v.strip('"') for k, v in _m3u8_attr.findall(value)}
+
+
+def _server_response(markup: bytes) -> str | None:
+    """Find the server-response meta tag without building a tree."""
+    start = 0
+    while (i := markup.find(b'server-response', start)) >= 0:
+        start = i + 1
+        if match := _meta.match(markup, markup.rfind(b'<', 0, i)):
+            attrs: dict[bytes, bytes] = {
+                name.lower(): dq or sq or uq
+                for name, dq, sq, uq in _attr.findall(match[1])
+            }
+            if attrs.get(b'name') == b'server-response':
+                if (content := attrs.get(b'content')) is not None:
+                    return html.unescape(content.decode())
+    return None
+
+
+def _server_response_bs4(markup: bytes):
+    import bs4
+
+    match bs4.BeautifulSoup(markup, 'html.parser').find(
+        name='meta',
+        attrs={'name': 'server-response', 'content': True},
+    ):
+        case bs4.Tag(attrs={'content': str(content)}):
+            return content
+        case _:
+            raise LookupError()
+
+
+_attr = re.compile(
+    rb'''
+    ([^\s"'=<>/]+)
+    (?: \s*=\s* (?: "([^"]*)" | '([^']*)' | ([^\s"'=<>`]+) ) )?
+    ''',
+    re.VERBOSE,
+)
+_m3u8_attr = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+_meta = re.compile(
+    rb'''
+    <meta
+    (  # Attributes
+        (?: \s+ [^\s"'=<>/]+
+            (?: \s*=\s* (?: "[^"]*" | '[^']*' | [^\s"'=<>`]+ ) )?
+        )*
+    )
+    \s* /?>
+    ''',
+    re.IGNORECASE | re.VERBOSE,
+)
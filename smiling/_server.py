@@ -0,0 +1,206 @@
+__all__ = ('serve',)
+
+import asyncio
+import collections
+import http
+import itertools
+import logging
+import time
+
+import pydantic
+
+from . import _downloader
+from . import _main
+from . import _parser
+from ._types import Format
+from ._types import Job
+from ._types import JobRequest
+
+
+async def serve():
+    settings = _main.states.get()['settings']
+    server = _Server(
+        settings.queue_size,
+        settings.jobs_size,
+        settings.jobs_ttl,
+    )
+    async with asyncio.TaskGroup() as tg:
+        for _ in range(settings.workers):
+            tg.create_task(server.worker())
+        listener = await asyncio.start_server(
+            server.handle,
+            settings.bind,
+            settings.port,
+        )
+        async with listener:
+            _logger.info('Listening on %s:%d', settings.bind, settings.port)
+            await listener.serve_forever()
+
+
+class _Server:
+    """Job queue behind the HTTP API.
+
+    Finished jobs stay listed for `ttl` seconds, and only the latest
+    `history` of them are kept.
+    """
+
+    def __init__(self, maxsize: int, history: int, ttl: float):
+        self._counter = itertools.count(1)
+        self._downloads: dict[
+            tuple[str, Format, float | None, float | None],
+            asyncio.Task[str],
+        ] = {}
+        self._finished: collections.OrderedDict[int, float] = (
+            collections.OrderedDict()  # Job ID to when it finished
+        )
+        self._history = history
+        self._jobs: dict[int, Job] = {}
+        self._players: set[asyncio.Task[None]] = set()
+        self._prewarming: asyncio.Task[None] | None = None
+        self._queue: asyncio.Queue[Job] = asyncio.Queue(maxsize)
+        self._ttl = ttl
+
+    async def handle(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ):
+        try:
+            try:
+                status, body = await self._route(reader)
+            except (
+                asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError,
+                ValueError,
+            ) as e:
+                status, body = http.HTTPStatus.BAD_REQUEST, _error(e)
+            if isinstance(body, str):
+                body = body.encode()
+                content_type = 'text/plain; version=0.0.4'
+            else:
+                content_type = 'application/json'
+            header = (
+                f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+                'Connection: close\r\n'
+                f'Content-Type: {content_type}\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                '\r\n'
+            )
+            writer.write(header.encode('ascii') + body)
+            await writer.drain()
+        except OSError as e:  # Including resets by the client
+            _logger.debug('Client connection lost: %r', e)
+        finally:
+            writer.close()
+
+    async def worker(self):
+        while True:
+            job = await self._queue.get()
+            job.status = 'running'
+            try:
+                job.output = await self._download(job)
+            except Exception as e:
+                job.status = 'failed'
+                job.error = repr(e)
+            else:
+                job.status = 'done'
+                if job.play:
+                    task = asyncio.create_task(
+                        _main.play(job.video_id, job.output),
+                    )
+                    self._players.add(task)
+                    task.add_done_callback(self._players.discard)
+            finally:
+                self._finished[job.id] = time.monotonic()
+                self._evict()
+                self._queue.task_done()
+
+    def _download(self, job: Job):
+        """Share one download between the jobs asking for the same file."""
+        key = job.video_id, job.format, job.start, job.end
+        if (task := self._downloads.get(key)) is None:
+            task = asyncio.create_task(
+                _downloader.download(
+                    job.video_id,
+                    job.format,
+                    start=job.start,
+                    end=job.end,
+                ),
+            )
+            self._downloads[key] = task
+            task.add_done_callback(lambda _: self._downloads.pop(key))
+        return asyncio.shield(task)  # A cancelled job leaves it to the rest
+
+    def _evict(self):
+        expired = time.monotonic() - self._ttl
+        while self._finished:
+            id_, finished = next(iter(self._finished.items()))
+            if finished > expired and len(self._finished) <= self._history:
+                break
+            del self._finished[id_]
+            del self._jobs[id_]
+
+    def _prewarm(self):
+        if self._prewarming and not self._prewarming.done():
+            return
+        states = _main.states.get()
+        self._prewarming = asyncio.create_task(
+            _downloader.prewarm(states['client'], states['settings']),
+        )
+
+    async def _route(self, reader: asyncio.StreamReader):
+        line = await reader.readuntil(b'\r\n')
+        method, target, _version = line.decode('ascii').split()
+        length = 0
+        while (line := await reader.readuntil(b'\r\n')) != b'\r\n':
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+        body = await reader.readexactly(length)
+        self._evict()
+        match method, target.strip('/').split('/'):
+            case 'GET', ['metrics']:
+                metrics = _main.states.get()['metrics']
+                return http.HTTPStatus.OK, metrics.render()
+            case 'GET', ['jobs']:
+                jobs = list(self._jobs.values())
+                return http.HTTPStatus.OK, _jobs.dump_json(jobs)
+            case 'GET', ['jobs', str(n)] if n.isdecimal():
+                if job := self._jobs.get(int(n)):
+                    return http.HTTPStatus.OK, job.model_dump_json().encode()
+                return http.HTTPStatus.NOT_FOUND, _error(LookupError(n))
+            case 'POST', ['jobs']:
+                try:
+                    request = JobRequest.model_validate_json(body)
+                    video_id = _parser.parse_id(request.audio)
+                except (pydantic.ValidationError, ValueError) as e:
+                    return http.HTTPStatus.UNPROCESSABLE_ENTITY, _error(e)
+                job = Job(
+                    id=next(self._counter),
+                    video_id=video_id,
+                    format=request.format,
+                    start=request.start,
+                    end=request.end,
+                    play=request.play,
+                )
+                try:
+                    self._queue.put_nowait(job)
+                except asyncio.QueueFull as e:
+                    return http.HTTPStatus.SERVICE_UNAVAILABLE, _error(e)
+                self._jobs[job.id] = job
+                self._prewarm()
+                return http.HTTPStatus.ACCEPTED, job.model_dump_json().encode()
+            case _, ['jobs'] | ['jobs', _] | ['metrics']:
+                status = http.HTTPStatus.METHOD_NOT_ALLOWED
+                return status, _error(LookupError(method))
+            case _:
+                return http.HTTPStatus.NOT_FOUND, _error(LookupError(target))
+
+
+def _error(e: Exception, /):
+    return _errors.dump_json({'error': repr(e)})
+
+
+_errors = pydantic.TypeAdapter(dict[str, str])
+_jobs = pydantic.TypeAdapter(list[Job])
+_logger = logging.getLogger(__package__)
@@ -1,36 +1,56 @@
 __all__ = [
     'Content',
     'Domand',
+    'DomandItem',
     'EventHooks',
     'Format',
     'HLS',
+    'Job',
+    'JobRequest',
     'Lib',
+    'LibCrypto',
     'M3U8',
+    'Playlist',
+    'PlaylistKey',
+    'PlaylistSegment',
+    'PlaylistURI',
     'Settings',
     'States',
 ]
 
-import asyncio
+import concurrent.futures
 from collections.abc import Callable
 from collections.abc import Coroutine
 from typing import Annotated
 from typing import Any
 from typing import Literal
+from typing import NamedTuple
 from typing import override
 from typing import Protocol
+from typing import TYPE_CHECKING
 from typing import TypedDict
 
 from annotated_types import Le
-import cffi
-import httpcore2 as httpcore
-import httpx2 as httpx
 import pydantic
 import pydantic_settings
 
+if TYPE_CHECKING:  # Keep the CLI parser from importing the downloader
+    import httpx2 as httpx
+
+    from ._cache import SegmentCache
+    from ._cache import TTLCache
+    from ._crypto import Backend
+    from ._downloader import Source
+    from ._library import Library
+    from ._limiter import Budget
+    from ._limiter import Memory
+    from ._limiter import Pool
+    from ._metrics import Metrics
+
 assert __package__
 
 type _EventHooks[T] = list[Callable[[T], Coroutine[Any, Any, object]]]
-EventHooks = dict[str, _EventHooks[httpx.Request] | _EventHooks[httpx.Response]]
+type EventHooks = dict[str, _EventHooks[httpx.Request] | _EventHooks[httpx.Response]]
 Format = Literal['best', 'worst']
 
 
@@ -45,7 +65,7 @@ class _ContentMeta(pydantic.BaseModel):
     status: Literal[200]
 
 
-class _DomandItem(pydantic.BaseModel):
+class DomandItem(pydantic.BaseModel):
     id: str
     isAvailable: bool
     qualityLevel: pydantic.NonNegativeInt
@@ -55,8 +75,8 @@ class _DomandItem(pydantic.BaseModel):
 
 class Domand(pydantic.BaseModel):
     accessRightKey: str
-    audios: list[_DomandItem]
-    videos: list[_DomandItem]
+    audios: list[DomandItem]
+    videos: list[DomandItem]
 
     model_config = pydantic.ConfigDict(extra='ignore')
 
@@ -76,6 +96,28 @@ class HLS(pydantic.BaseModel):
     meta: _HLSMeta
 
 
+class Job(pydantic.BaseModel):
+    id: int
+    video_id: str
+    format: Format
+    start: float | None = None
+    end: float | None = None
+    play: bool
+    status: Literal['queued', 'running', 'done', 'failed'] = 'queued'
+    output: str | None = None
+    error: str | None = None
+
+
+class JobRequest(pydantic.BaseModel):
+    audio: str
+    format: Format = 'worst'
+    start: pydantic.NonNegativeFloat | None = None
+    end: pydantic.PositiveFloat | None = None
+    play: bool = False
+
+    model_config = pydantic.ConfigDict(extra='forbid')
+
+
 class Lib(Protocol):
     def av_aes_init(
         self,
@@ -96,6 +138,34 @@ class Lib(Protocol):
     ) -> None: ...
 
 
+class LibCrypto(Protocol):
+    def EVP_aes_128_cbc(self) -> Any: ...
+
+    def EVP_CIPHER_CTX_new(self) -> Any: ...
+
+    def EVP_CIPHER_CTX_free(self, ctx: Any) -> None: ...
+
+    def EVP_CIPHER_CTX_set_padding(self, ctx: Any, pad: int) -> int: ...
+
+    def EVP_DecryptInit_ex(
+        self,
+        ctx: Any,
+        cipher: Any,
+        impl: Any,
+        key: Any,
+        iv: Any,
+    ) -> int: ...
+
+    def EVP_DecryptUpdate(
+        self,
+        ctx: Any,
+        out: Any,
+        outl: Any,
+        in_: Any,
+        inl: int,
+    ) -> int: ...
+
+
 class _M3U8Header(pydantic.BaseModel):
     uri: str
 
@@ -109,6 +179,7 @@ class _M3U8Media(pydantic.BaseModel):
 
 
 class _M3U8Segment(pydantic.BaseModel):
+    duration: pydantic.NonNegativeFloat
     uri: str
 
     model_config = pydantic.ConfigDict(extra='ignore')
@@ -149,6 +220,30 @@ class _Payment(pydantic.BaseModel):
     model_config = pydantic.ConfigDict(extra='ignore')
 
 
+class PlaylistKey(NamedTuple):
+    iv: int
+    uri: str
+
+
+class PlaylistSegment(NamedTuple):
+    duration: float
+    uri: str
+
+
+class PlaylistURI(NamedTuple):
+    uri: str
+
+
+class Playlist(NamedTuple):
+    """The subset of an HLS playlist the downloader reads."""
+
+    keys: list[PlaylistKey]
+    media: list[PlaylistURI]
+    segment_map: list[PlaylistURI]
+    segments: list[PlaylistSegment]
+    targetduration: int | None
+
+
 class _Video(pydantic.BaseModel):
     id: str
     isDeleted: Literal[False]
@@ -183,9 +278,36 @@ class Content(pydantic.BaseModel):
 
 
 class Settings(pydantic_settings.BaseSettings):
-    hosts: dict[str, str] = {}
+    aes: Literal['auto', 'avutil', 'openssl', 'python'] = 'auto'
+    bind: str = '127.0.0.1'
+    buffer_size: pydantic.PositiveInt = 1 << 28  # Bytes of segments in flight
+    cache_size: pydantic.NonNegativeInt = 1 << 31  # Bytes
+    cafile: str | None = None
+    data_dir: str | None = None
+    decrypt_threads: pydantic.PositiveInt | None = None
+    hedge_budget: pydantic.NonNegativeFloat = 0  # Per request, 0 is off
+    hedge_percentile: Annotated[pydantic.PositiveInt, Le(99)] = 95
+    hosts: dict[str, str | list[str]] = {}  # Candidate fronts
+    jobs_size: pydantic.NonNegativeInt = 1000  # Finished jobs kept
+    jobs_ttl: pydantic.NonNegativeFloat = 3600  # Seconds finished jobs stay
+    keepalive_expiry: pydantic.NonNegativeFloat = 30
+    max_connections: pydantic.PositiveInt = 20
+    max_connections_per_host: pydantic.PositiveInt = 8
+    metadata_size: pydantic.PositiveInt = 256  # Entries of each kind
+    metadata_ttl: pydantic.NonNegativeFloat = 600  # Seconds, 0 is off
+    metadata_workers: pydantic.PositiveInt = 2  # Batch pipeline stages
+    mux: Literal['ffmpeg', 'fmp4', 'mp4'] = 'mp4'
+    mux_workers: pydantic.PositiveInt = 2
     parallel: pydantic.PositiveInt = 5
-    sni_hostname: dict[str, str] = {}
+    parallel_max: pydantic.PositiveInt = 32
+    parallel_min: pydantic.PositiveInt = 1
+    parallel_per_host: bool = False
+    port: Annotated[pydantic.PositiveInt, Le(0xffff)] = 2525
+    prewarm: pydantic.NonNegativeInt = 0  # Connections per remapped host
+    queue_size: pydantic.NonNegativeInt = 0
+    sni_hostname: dict[str, str | list[str]] = {}
+    strict_m3u8: bool = False
+    workers: pydantic.PositiveInt = 2
 
     model_config = pydantic_settings.SettingsConfigDict(
         pyproject_toml_table_header=('tool', __package__),
@@ -207,10 +329,17 @@ class Settings(pydantic_settings.BaseSettings):
 
 
 class States(TypedDict):
-    event_hooks: EventHooks
-    ffi: cffi.FFI
-    lib: Lib
+    aes: Backend
+    cache: SegmentCache
+    client: httpx.AsyncClient
+    executor: concurrent.futures.ThreadPoolExecutor
+    hedges: Budget
+    library: Library
     log_dir: str
-    network_backend: httpcore.AsyncNetworkBackend
+    memory: Memory
+    metrics: Metrics
     output_dir: str
-    pool: asyncio.BoundedSemaphore
+    pages: TTLCache[str, _Response]
+    pool: Pool
+    settings: Settings
+    sources: TTLCache[tuple[str, Format], Source]
@@ -0,0 +1,23 @@
+import pkgutil
+import subprocess
+import sys
+import unittest
+
+import smiling
+
+
+class TestImport(unittest.TestCase):
+    def test_modules(self):
+        """Import every module first, in a fresh interpreter each."""
+        for module in pkgutil.iter_modules(smiling.__path__):
+            with self.subTest(module.name):
+                result = subprocess.run(
+                    [sys.executable, '-c', f'import smiling.{module.name}'],
+                    capture_output=True,
+                    text=True,
+                )
+                self.assertEqual(result.returncode, 0, result.stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,223 @@
+import os
+import struct
+import tempfile
+import unittest
+
+from smiling import _mp4
+
+
+class TestWriter(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.output_file = os.path.join(tmp.name, 'out.m4a')
+        self.samples = [
+            [bytes([i * 16 + j]) * (100 + i * 16 + j) for j in range(5)]
+            for i in range(3)
+        ]
+
+    def test_fragmented(self):
+        data = self._mux(plain=False)
+        self.assertEqual(
+            [type_ for type_, _ in _boxes(data)],
+            [b'ftyp', b'moov'] + [b'moof', b'mdat'] * 3,
+        )
+        moov = _find(data, b'moov')
+        self.assertEqual(_comment(moov), 'sm9')
+        counts = [
+            struct.unpack_from('>I', trun, 4)[0]  # After version and flags
+            for trun in _find_all(data, b'moof', b'traf', b'trun')
+        ]
+        self.assertEqual(sum(counts), _COUNT)
+
+    def test_plain(self):
+        data = self._mux(plain=True)
+        types = [type_ for type_, _ in _boxes(data)]
+        self.assertEqual(types.count(b'moov'), 1)
+        self.assertNotIn(b'moof', types)
+        moov = _find(data, b'moov')
+        self.assertEqual(_comment(moov), 'sm9')
+        mvhd = _find(moov, b'mvhd')
+        self.assertEqual(_duration(mvhd), _COUNT * _DELTA * 1000 // _RATE)
+        mdia = _find(moov, b'trak', b'mdia')
+        self.assertEqual(_duration(_find(mdia, b'mdhd')), _COUNT * _DELTA)
+        stbl = _find(mdia, b'minf', b'stbl')
+        self.assertEqual(
+            struct.unpack_from('>III', _find(stbl, b'stts'), 4),
+            (1, _COUNT, _DELTA),
+        )
+        _, count, *sizes = struct.unpack_from(
+            f'>II{_COUNT}I',
+            _find(stbl, b'stsz'),
+            4,
+        )
+        self.assertEqual(count, _COUNT)
+        self.assertEqual(
+            sizes,
+            [len(sample) for samples in self.samples for sample in samples],
+        )
+        chunks, *offsets = struct.unpack_from('>4I', _find(stbl, b'stco'), 4)
+        self.assertEqual(chunks, 3)
+        for offset, samples in zip(offsets, self.samples, strict=True):
+            chunk = b''.join(samples)
+            self.assertEqual(data[offset:offset + len(chunk)], chunk)
+
+    def test_unsupported_fragment_stays_fragmented(self):
+        # A track run without a data offset needs a real muxer
+        data = self._mux(plain=True, trun_flags=0x200)
+        types = [type_ for type_, _ in _boxes(data)]
+        self.assertEqual(types.count(b'moof'), 3)
+        self.assertEqual(_comment(_find(data, b'moov')), 'sm9')
+
+    def _mux(self, *, plain: bool, trun_flags: int = 0x201):
+        with _mp4.Writer(self.output_file, _init(), 'sm9', plain=plain) as w:
+            decode_time = 0
+            for i, samples in enumerate(self.samples, 1):
+                w.write(_fragment(i, decode_time, samples, trun_flags))
+                decode_time += len(samples) * _DELTA
+            w.finish()
+        with open(self.output_file, 'rb') as f:
+            return f.read()
+
+
+def _box(type_: bytes, /, *payload: bytes):
+    size = 8 + sum(map(len, payload))
+    return b''.join([struct.pack('>I4s', size, type_), *payload])
+
+
+def _boxes(data: bytes, /):
+    """Yield the type and payload of each box."""
+    start = 0
+    while start < len(data):
+        size, type_ = struct.unpack_from('>I4s', data, start)
+        yield type_, data[start + 8:start + size]
+        start += size
+
+
+def _comment(moov: bytes, /):
+    data = _find(moov, b'udta', b'meta')[4:]  # After the version and flags
+    value = _find(data, b'ilst', b'\xa9cmt', b'data')
+    return value[8:].decode()
+
+
+def _duration(header: bytes, /):
+    """Read the duration of a version 0 mvhd or mdhd payload."""
+    return struct.unpack_from('>I', header, 16)[0]
+
+
+def _find(data: bytes, /, *path: bytes):
+    return next(_find_all(data, *path))
+
+
+def _find_all(data: bytes, /, *path: bytes):
+    type_, *rest = path
+    for child_type, payload in _boxes(data):
+        if child_type == type_:
+            if rest:
+                yield from _find_all(payload, *rest)
+            else:
+                yield payload
+
+
+def _fragment(
+    sequence: int,
+    decode_time: int,
+    samples: list[bytes],
+    trun_flags: int,
+):
+    def moof(data_offset: int):
+        trun = [struct.pack('>I', len(samples))]
+        if trun_flags & 0x1:
+            trun.append(struct.pack('>i', data_offset))
+        trun.extend(struct.pack('>I', len(sample)) for sample in samples)
+        return _box(
+            b'moof',
+            _full(b'mfhd', 0, 0, struct.pack('>I', sequence)),
+            _box(
+                b'traf',
+                _full(b'tfhd', 0, 0x20000, struct.pack('>I', 1)),
+                _full(b'tfdt', 1, 0, struct.pack('>Q', decode_time)),
+                _full(b'trun', 0, trun_flags, *trun),
+            ),
+        )
+
+    data_offset = len(moof(0)) + 8
+    return moof(data_offset) + _box(b'mdat', *samples)
+
+
+def _full(type_: bytes, version: int, flags: int, /, *payload: bytes):
+    return _box(type_, struct.pack('>I', version << 24 | flags), *payload)
+
+
+def _init():
+    matrix = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+    stbl = _box(
+        b'stbl',
+        _full(b'stsd', 0, 0, struct.pack('>I', 0)),
+        _full(b'stts', 0, 0, struct.pack('>I', 0)),
+        _full(b'stsc', 0, 0, struct.pack('>I', 0)),
+        _full(b'stsz', 0, 0, struct.pack('>II', 0, 0)),
+        _full(b'stco', 0, 0, struct.pack('>I', 0)),
+    )
+    trak = _box(
+        b'trak',
+        _full(
+            b'tkhd',
+            0,
+            3,
+            struct.pack('>5I', 0, 0, 1, 0, 0),
+            bytes(8),
+            struct.pack('>hhhh', 0, 0, 0x100, 0),
+            matrix,
+            struct.pack('>II', 0, 0),
+        ),
+        _box(
+            b'mdia',
+            _full(b'mdhd', 0, 0, struct.pack('>4IHH', 0, 0, _RATE, 0, 0, 0)),
+            _full(b'hdlr', 0, 0, bytes(4), b'soun', bytes(12), b'\0'),
+            _box(
+                b'minf',
+                _full(b'smhd', 0, 0, bytes(4)),
+                _box(
+                    b'dinf',
+                    _full(
+                        b'dref',
+                        0,
+                        0,
+                        struct.pack('>I', 1),
+                        _full(b'url ', 0, 1),
+                    ),
+                ),
+                stbl,
+            ),
+        ),
+    )
+    moov = _box(
+        b'moov',
+        _full(
+            b'mvhd',
+            0,
+            0,
+            struct.pack('>4I', 0, 0, 1000, 0),
+            struct.pack('>IH', 0x10000, 0x100),
+            bytes(10),
+            matrix,
+            bytes(24),
+            struct.pack('>I', 2),
+        ),
+        trak,
+        _box(
+            b'mvex',
+            _full(b'trex', 0, 0, struct.pack('>5I', 1, 1, _DELTA, 0, 0)),
+        ),
+    )
+    return _box(b'ftyp', b'iso6', bytes(4), b'iso6mp41') + moov
+
+
+_COUNT = 15  # Samples in the 3 fragments
+_DELTA = 1024  # Sample duration, as an AAC frame
+_RATE = 48000  # Media timescale
+
+
+if __name__ == '__main__':
+    unittest.main()